@@ -0,0 +1,105 @@
+"""
+Measure the startup cost of the CLI with `python -X importtime` and fail when
+a command imports more than its budget allows.
+
+Usage: python -m benchmarks.import_time [--top N] [--scale FACTOR]
+"""
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+import click
+
+# Command line -> import time budget in ms
+BUDGETS = {
+    "--help": 100,
+    "compensate --help": 400,
+    "compensate-batch --help": 400,
+    "convert --help": 350,
+    "refine --help": 400,
+    "scanpath --help": 350,
+    "visualize --help": 400,
+}
+
+# Modules that no command may import before it actually runs
+FORBIDDEN = ["plotly", "pygame", "scipy", "nicegui"]
+# Listing the commands imports none of them
+HELP_FORBIDDEN = ["numpy", "cv2", "drlcd.image", "drlcd.compensation", "drlcd.batch",
+                  "drlcd.io", "drlcd.refine", "drlcd.path"]
+
+def forbiddenModules(command: str) -> List[str]:
+    return FORBIDDEN + HELP_FORBIDDEN if command == "--help" else FORBIDDEN
+
+def measureImports(arguments: List[str]) -> Tuple[float, Dict[str, int]]:
+    """
+    Run the CLI and return the wall time in seconds and the cumulative import
+    time in µs and the nesting level of every module.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", "drlcd"] + arguments,
+                             capture_output=True, text=True, env=env)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"drlcd {' '.join(arguments)} failed:\n{process.stderr}")
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(cumulative), level)
+    return elapsed, modules
+
+def staleHelp() -> List[str]:
+    """
+    Commands whose short help in COMMANDS differs from their docstring
+    """
+    import importlib
+    from drlcd.__main__ import COMMANDS
+    # Limit of click's command listing at the default width of 80 columns
+    limit = 80 - 6 - max(len(name) for name in COMMANDS)
+    stale = []
+    for name, (target, shortHelp) in COMMANDS.items():
+        module, attribute = target.split(":")
+        command = getattr(importlib.import_module(f"drlcd.{module}"), attribute)
+        if command.get_short_help_str(limit) != shortHelp:
+            stale.append(name)
+    return stale
+
+def topLevel(modules: Dict[str, Tuple[int, int]]) -> List[Tuple[int, str]]:
+    """
+    Cumulative import times of the modules not imported by another module
+    """
+    return sorted(((t, name) for name, (t, level) in modules.items() if level == 0), reverse=True)
+
+@click.command()
+@click.option("--top", type=int, default=5,
+    help="Number of slowest top-level modules to list per command")
+@click.option("--scale", type=float, default=1.0,
+    help="Multiply the budgets, e.g. for slow machines")
+def main(top, scale):
+    failed = False
+    print(f"{'command':<26} {'wall [ms]':>10} {'imports [ms]':>13} {'budget [ms]':>12}")
+    for command, budget in BUDGETS.items():
+        elapsed, modules = measureImports(command.split())
+        imported = topLevel(modules)
+        imports = sum(t for t, _ in imported) / 1000
+        limit = budget * scale
+        forbidden = [m for m in forbiddenModules(command) if m in modules]
+        status = "ok" if imports <= limit and not forbidden else "OVER BUDGET"
+        print(f"{command:<26} {elapsed * 1000:>10.0f} {imports:>13.0f} {limit:>12.0f} {status}")
+        if forbidden:
+            print(f"    imports {', '.join(forbidden)}")
+        print("    " + ", ".join(f"{n} {t / 1000:.0f}" for t, n in imported[:top]))
+        failed = failed or status != "ok"
+    stale = staleHelp()
+    if stale:
+        print(f"Short help in COMMANDS out of date: {', '.join(stale)}")
+    sys.exit(1 if failed or stale else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Compare the vectorized `drlcd.image.locateScreenAutomatic` with the original
+pairwise implementation on synthetic measurements of rotated and perspective
+distorted screens, and check that it finds the true corners with sub-pixel
+precision.
+
+Usage: python -m benchmarks.locate_screen [--skip-reference-above CELLS]
+"""
+import itertools
+import math
+import time
+import click
+import numpy as np
+import cv2 as cv
+
+from drlcd.image import clusterLines, intersectLines, locateScreenAutomatic
+
+SIZES = [(113, 65), (1000, 650), (4000, 2500)]
+LINE_COUNTS = [50, 200, 1000]
+# Largest corner error in px; the reference returns integer points
+TOLERANCE = 0.25
+REFERENCE_TOLERANCE = 1.5
+
+# Rotation in degrees and perspective skew as a fraction of the screen size
+DISTORTIONS = [(0, 0), (2, 0), (-2, 0), (7, 0), (-7, 0), (10, 0), (-10, 0),
+               (0, 0.05), (3, 0.04), (-5, 0.08), (8, -0.06)]
+
+def lineIntersection(line1, line2):
+    rho1, theta1 = line1
+    rho2, theta2 = line2
+    A = np.array([
+        [np.cos(theta1), np.sin(theta1)],
+        [np.cos(theta2), np.sin(theta2)]
+    ])
+    b = np.array([[rho1], [rho2]])
+    try:
+        x0, y0 = np.linalg.solve(A, b)
+    except np.linalg.LinAlgError:
+        return None
+    # Index the 1-element rows; NumPy 2 no longer converts them to scalars
+    x0, y0 = int(np.round(x0[0])), int(np.round(y0[0]))
+    return (x0, y0)
+
+def locateScreenReference(image, threshold):
+    """
+    The original implementation without the debug drawing. It returns all
+    line intersections within the image rather than four corners.
+    """
+    npImg = np.array(image)
+    ret, thresholded = cv.threshold(npImg, threshold, 255, cv.THRESH_BINARY)
+    thresholded = np.uint8(thresholded)
+
+    contours, hierarchy = cv.findContours(thresholded, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+
+    countoursImg = np.zeros((len(image), len(image[0])), dtype=np.uint8)
+    cv.drawContours(countoursImg, contours, 0, 255,  1)
+
+    lines = cv.HoughLines(countoursImg, 0.5, np.pi / 360, len(image[0]) // 5, None, 0, 0, 0, 3 / 4 * np.pi)
+    return intersectionsReference(lines, image)
+
+def intersectionsReference(lines, image):
+    """
+    The deduplication of lines and the pairwise intersections of the original
+    """
+    def thetaClose(a, b):
+        return abs(a - b) < np.pi / 40
+
+    def rhoClose(a, b):
+        return abs(a - b) < 10
+
+    strongLines = []
+    if lines is not None:
+        for line in lines:
+            rho, theta = line[0][0], line[0][1]
+            if any(rhoClose(rho, l[0]) and thetaClose(theta, l[1]) for l in strongLines):
+                continue
+            strongLines.append((rho, theta))
+
+    intersections = [lineIntersection(l1, l2) for l1, l2 in itertools.product(strongLines, strongLines) if l1 != l2]
+    fitsInImage = lambda p: p[0] > 0 and p[0] <= len(image[0]) and p[1] > 0 and p[1] <= len(image)
+    return list(set([x for x in intersections if x is not None and fitsInImage(x)]))
+
+def syntheticScreen(width, height, rotation, skew, seed=0):
+    """
+    A measurement of a screen covering about 70% of the scan area, rotated by
+    rotation degrees and with the bottom edge widened by skew, over a dark
+    noisy background. Returns the image and the true corners in the order of
+    defaultCorners.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = 0.7 * width, 0.7 * height
+    corners = np.float64([[-w / 2, -h / 2], [-w / 2 - skew * w, h / 2],
+                          [w / 2, -h / 2], [w / 2 + skew * w, h / 2]])
+    angle = math.radians(rotation)
+    rotate = np.float64([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+    corners = corners @ rotate.T + [width / 2, height / 2]
+
+    y, x = np.mgrid[0:height, 0:width]
+    image = 4 + np.exp(-(((x - width / 2) / width) ** 2 + ((y - height / 2) / height) ** 2))
+    # The sensor integrates over a cell, approximate the covered fraction of
+    # every cell by the distance of its center from the nearest edge
+    around = corners[[0, 2, 3, 1]]
+    distance = np.full(image.shape, np.inf)
+    for start, end in zip(around, np.roll(around, -1, axis=0)):
+        normal = np.array([start[1] - end[1], end[0] - start[0]]) / np.hypot(*(end - start))
+        distance = np.minimum(distance, (x + 0.5 - start[0]) * normal[0] + (y + 0.5 - start[1]) * normal[1])
+    coverage = np.clip(0.5 + distance, 0, 1)
+    image = coverage * image + (1 - coverage) * 0.1 + rng.normal(0, 0.02, image.shape)
+    return image.astype(np.float32), corners
+
+def cornerError(found, expected) -> float:
+    """
+    Largest distance of an expected corner from the nearest found point
+    """
+    if not found:
+        return math.inf
+    found = np.float64(found)
+    return max(np.min(np.hypot(*(found - corner).T)) for corner in expected)
+
+def syntheticLines(count, width, height, seed=0):
+    """
+    Hough lines (rho, theta) in the (1, 2) rows of cv.HoughLines around a
+    noisy screen outline
+    """
+    rng = np.random.default_rng(seed)
+    edges = np.float64([[0.15 * width, 0], [0.85 * width, 0], [0.15 * height, np.pi / 2], [0.85 * height, np.pi / 2]])
+    lines = edges[rng.integers(0, 4, count)] + rng.normal(0, [20, 0.05], (count, 2))
+    return lines.reshape(-1, 1, 2).astype(np.float32)
+
+def timeIt(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+@click.command()
+@click.option("--skip-reference-above", type=int, default=1_000_000,
+    help="Do not run the slow reference on images with more cells")
+def main(skip_reference_above):
+    print(f"{'image':>12} {'distortion':>12} {'reference':>12} {'found':>6} "
+          f"{'vectorized':>12} {'error [px]':>11} {'speedup':>9}")
+    failed = []
+    for width, height in SIZES:
+        for rotation, skew in DISTORTIONS:
+            image, expected = syntheticScreen(width, height, rotation, skew)
+            threshold = 2.0
+            newTime, corners = timeIt(locateScreenAutomatic, image, threshold)
+            error = cornerError(corners, expected)
+            if corners is None or len(corners) != 4 or error > TOLERANCE:
+                failed.append((width, height, rotation, skew, error))
+            distortion = f"{rotation:+d}° {skew:+.2f}"
+            if image.size > skip_reference_above:
+                print(f"{width:>5}x{height:<6} {distortion:>12} {'skipped':>12} {'-':>6} "
+                      f"{newTime:>11.4f}s {error:>11.2f} {'-':>9}")
+                continue
+            oldTime, points = timeIt(locateScreenReference, image, threshold)
+            found = "yes" if cornerError(points, expected) <= REFERENCE_TOLERANCE else "no"
+            print(f"{width:>5}x{height:<6} {distortion:>12} {oldTime:>11.4f}s {found:>6} "
+                  f"{newTime:>11.4f}s {error:>11.2f} {oldTime / newTime:>8.1f}x")
+    for width, height, rotation, skew, error in failed:
+        print(f"FAILED {width}x{height} rotation {rotation}° skew {skew}: error {error:.2f} px")
+
+    # Noisy outlines give many Hough lines; the pairwise stage dominates then
+    print(f"\n{'lines':>12} {'reference':>12} {'vectorized':>12} {'speedup':>9}")
+    image = np.zeros((2500, 4000), dtype=np.float32)
+    for count in LINE_COUNTS:
+        lines = syntheticLines(count, 4000, 2500)
+        oldTime, _ = timeIt(intersectionsReference, lines, image)
+        newTime, _ = timeIt(lambda l: intersectLines(clusterLines(l)), lines)
+        print(f"{count:>12} {oldTime:>11.4f}s {newTime:>11.4f}s {oldTime / newTime:>8.0f}x")
+    assert not failed
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare the vectorized `drlcd.image.replacePeaks` with the original
+per-cell implementation on synthetic measurement grids.
+
+Usage: python -m benchmarks.replace_peaks [--skip-reference-above CELLS]
+"""
+import time
+import click
+import numpy as np
+
+from drlcd.image import replacePeaks
+
+SIZES = [(200, 130), (1000, 650), (4000, 2500)]
+
+def replacePeaksReference(arr: np.array, threshold: float, windowSize: int):
+    """
+    The original nested-loop implementation. It skips border cells.
+    """
+    result = np.copy(arr)
+    height, width = arr.shape
+
+    halfWindow = windowSize // 2
+
+    for i in range(halfWindow, height - halfWindow):
+        for j in range(halfWindow, width - halfWindow):
+            if arr[i, j] > threshold:
+                localWindow = arr[i - halfWindow: i + halfWindow + 1, j - halfWindow: j + halfWindow + 1]
+                localWindowWithoutPeak = localWindow[localWindow != arr[i, j]]
+                localAverage = np.mean(localWindowWithoutPeak)
+                result[i, j] = localAverage
+
+    return result
+
+def syntheticGrid(width, height, seed=0):
+    """
+    A smooth backlight-like surface with sensor noise and sparse peaks.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    surface = 4 + np.exp(-(((x - width / 2) / width) ** 2 + ((y - height / 2) / height) ** 2))
+    surface += rng.normal(0, 0.02, surface.shape)
+    peaks = rng.random(surface.shape) < 0.001
+    surface[peaks] *= 3
+    return surface
+
+def timeIt(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+@click.command()
+@click.option("--skip-reference-above", type=int, default=1_000_000,
+    help="Do not run the slow reference on grids with more cells")
+def main(skip_reference_above):
+    print(f"{'grid':>12} {'reference':>12} {'vectorized':>12} {'speedup':>9}")
+    for width, height in SIZES:
+        grid = syntheticGrid(width, height)
+        threshold = 1.5 * np.mean(grid)
+        newTime, newResult = timeIt(replacePeaks, grid, threshold, 3)
+        if grid.size > skip_reference_above:
+            print(f"{width:>5}x{height:<6} {'skipped':>12} {newTime:>11.3f}s {'-':>9}")
+            continue
+        oldTime, oldResult = timeIt(replacePeaksReference, grid, threshold, 3)
+        # The reference leaves the border alone, compare only the interior
+        assert np.allclose(oldResult[1:-1, 1:-1], newResult[1:-1, 1:-1])
+        print(f"{width:>5}x{height:<6} {oldTime:>11.3f}s {newTime:>11.3f}s {oldTime / newTime:>8.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,50 @@
+import importlib
 import click
 
-from .image import visualize, compensate
+# Subcommands are imported only when used so the CLI starts fast; each entry
+# is "module:attribute" relative to this package and the short help listed by
+# --help without importing the module
+COMMANDS = {
+    "visualize": ("image:visualize", "Plot a measurement as an interactive 3D surface in a..."),
+    "compensate": ("image:compensate", "Build a compensation mask for a given LCD."),
+    "compensate-batch": ("batch:compensate_batch", "Build compensation masks for many measurements listed..."),
+    "convert": ("io:convert", "Convert a measurement between the JSON and the binary..."),
+    "refine": ("refine:refine", "Refine a compensation mask from a measurement taken..."),
+    "scanpath": ("path:scanpath", "Estimate the scan time of a grid measurement for each..."),
+}
 
-@click.group()
+class LazyGroup(click.Group):
+    def __init__(self, *args, lazyCommands=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazyCommands = lazyCommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazyCommands))
+
+    def get_command(self, ctx, name):
+        if name not in self.lazyCommands:
+            return super().get_command(ctx, name)
+        module, attribute = self.lazyCommands[name][0].split(":")
+        return getattr(importlib.import_module(f".{module}", __package__), attribute)
+
+    def format_commands(self, ctx, formatter):
+        names = self.list_commands(ctx)
+        limit = formatter.width - 6 - max((len(name) for name in names), default=0)
+        rows = []
+        for name in names:
+            if name in self.lazyCommands:
+                rows.append((name, self.lazyCommands[name][1]))
+            else:
+                command = super().get_command(ctx, name)
+                if command is not None and not command.hidden:
+                    rows.append((name, command.get_short_help_str(limit)))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+@click.group(cls=LazyGroup, lazyCommands=COMMANDS)
 def cli():
     pass
 
-cli.add_command(visualize)
-cli.add_command(compensate)
-
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,150 @@
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
+import click
+from .profiles import readConfigFile, resolveProfiles
+from .ui_common import Corners, Resolution
+
+if TYPE_CHECKING:
+    from .compensation import MaskResult
+
+class EntryResult(NamedTuple):
+    index: int
+    masks: List["MaskResult"]
+    error: Optional[str]
+    seconds: float  # Wall time of the whole entry including loading
+
+def _entryPath(base: str, path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(base, path)
+
+PIPELINES = ["screen", "native"]
+
+def _screenSize(value: Any) -> Tuple[int, int]:
+    """
+    Screen resolution given as "3840x2400" or as a pair of integers
+    """
+    if isinstance(value, str):
+        return Resolution().convert(value, None, None)
+    if isinstance(value, (list, tuple)) and len(value) == 2 and all(isinstance(x, int) for x in value):
+        return int(value[0]), int(value[1])
+    raise ValueError(f"Invalid screen resolution {value!r}, use \"3840x2400\" or [3840, 2400]")
+
+def readManifest(path: str) -> List[Dict[str, Any]]:
+    """
+    Read a TOML or JSON manifest of masks to build. It is either a list of
+    entries or has them under "masks"; a top-level "profile_file" applies to all
+    entries. Every entry has a measurement, screen resolution ("3840x2400" or
+    [3840, 2400]), output and optionally profile (a name or a list), min, max, pipeline,
+    tile_rows, encode (preset), depth and corners (pairs, "x1,y1;..." or a JSON
+    file). Without corners, the screen corners stored next to the measurement
+    are used like in compensate. Relative paths are relative to the manifest.
+    """
+    data = readConfigFile(path)
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = {} if isinstance(data, list) else data
+    entries = data if isinstance(data, list) else data.get("masks", [])
+    result = []
+    for i, entry in enumerate(entries):
+        for key in ["measurement", "screen", "output"]:
+            if key not in entry:
+                raise ValueError(f"Manifest entry {i} has no {key}")
+        pipeline = entry.get("pipeline", "screen")
+        if pipeline not in PIPELINES:
+            raise ValueError(f"Manifest entry {i} has unknown pipeline {pipeline}, use one of {', '.join(PIPELINES)}")
+        profiles = entry.get("profile", [])
+        corners = entry.get("corners")
+        if isinstance(corners, str) and os.path.isfile(_entryPath(base, corners)):
+            corners = _entryPath(base, corners)
+        profileFile = entry.get("profile_file", defaults.get("profile_file"))
+        result.append({
+            "measurement": _entryPath(base, entry["measurement"]),
+            "screen": _screenSize(entry["screen"]),
+            "output": _entryPath(base, entry["output"]),
+            "profiles": [profiles] if isinstance(profiles, str) else list(profiles),
+            "profile_file": _entryPath(base, profileFile) if profileFile else None,
+            "min": int(entry.get("min", 0)),
+            "max": int(entry.get("max", 255)),
+            "pipeline": pipeline,
+            "tile_rows": int(entry.get("tile_rows", 0)),
+            "encode": entry.get("encode", defaults.get("encode", "smallest")),
+            "depth": int(entry.get("depth", defaults.get("depth", 8))),
+            "corners": Corners().convert(corners, None, None) if corners is not None else None
+        })
+    return result
+
+def runEntry(index: int, entry: Dict[str, Any]) -> EntryResult:
+    """
+    Build the masks of a single manifest entry; errors are reported in the
+    result so one bad entry does not stop the batch.
+    """
+    from .compensation import compensateMeasurement
+    from .image import orderCorners, readScreenGeometry
+    from .io import loadMeasurement
+
+    start = time.perf_counter()
+    try:
+        profiles = resolveProfiles(entry["profiles"], entry["profile_file"])
+        data = loadMeasurement(entry["measurement"]).values
+        if entry["corners"] is not None:
+            corners = orderCorners(entry["corners"])
+        else:
+            corners = readScreenGeometry(entry["measurement"])
+        os.makedirs(os.path.dirname(entry["output"]), exist_ok=True)
+        masks = compensateMeasurement(data, entry["measurement"], entry["output"], entry["screen"],
+                                      entry["min"], entry["max"], corners, pipeline=entry["pipeline"],
+                                      tileRows=entry["tile_rows"], profiles=profiles, verbose=False,
+                                      preset=entry["encode"], depth=entry["depth"])
+        return EntryResult(index, masks, None, time.perf_counter() - start)
+    except Exception as e:
+        return EntryResult(index, [], f"{type(e).__name__}: {e}", time.perf_counter() - start)
+
+def printSummary(entries: List[Dict[str, Any]], results: List[EntryResult]) -> None:
+    print(f"{'output':<40} {'profile':>10} {'min':>7} {'mean':>7} {'max':>7} {'size [KB]':>10} "
+          f"{'encode [s]':>11} {'time [s]':>9}")
+    for result in results:
+        for mask in result.masks:
+            name = os.path.relpath(mask.output)
+            print(f"{name:<40} {mask.profile:>10} {mask.minimum:>7.1f} {mask.mean:>7.1f} "
+                  f"{mask.maximum:>7.1f} {mask.size / 1024:>10.1f} {mask.encodeSeconds:>11.2f} {mask.seconds:>9.2f}")
+    for result in results:
+        if result.error is not None:
+            print(f"Failed {entries[result.index]['measurement']}: {result.error}")
+
+@click.command("compensate-batch")
+@click.argument("manifest", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--jobs", "-j", type=int, default=os.cpu_count(),
+    help="Number of worker processes (default: number of CPUs)")
+def compensate_batch(manifest, jobs):
+    """
+    Build compensation masks for many measurements listed in a TOML or JSON
+    MANIFEST using a pool of worker processes, and print a summary.
+    """
+    try:
+        entries = readManifest(manifest)
+    except (ValueError, KeyError, click.BadParameter) as e:
+        raise click.BadParameter(str(e), param_hint="MANIFEST")
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    start = time.perf_counter()
+    results: List[EntryResult] = []
+    jobs = max(1, min(jobs or 1, len(entries)))
+    if jobs == 1:
+        for i, entry in enumerate(entries):
+            results.append(runEntry(i, entry))
+            print(f"[{len(results)}/{len(entries)}] {entry['measurement']} ({results[-1].seconds:.1f} s)")
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(runEntry, i, entry) for i, entry in enumerate(entries)]
+            for future in as_completed(futures):
+                results.append(future.result())
+                entry = entries[results[-1].index]
+                print(f"[{len(results)}/{len(entries)}] {entry['measurement']} ({results[-1].seconds:.1f} s)")
+    results.sort(key=lambda r: r.index)
+    elapsed = time.perf_counter() - start
+
+    print()
+    printSummary(entries, results)
+    masks = sum(len(r.masks) for r in results)
+    print(f"\n{masks} masks from {len(entries)} measurements in {elapsed:.1f} s "
+          f"with {jobs} workers ({sum(r.seconds for r in results):.1f} s of work)")
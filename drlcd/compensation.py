@@ -0,0 +1,864 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+import cv2 as cv
+from .io import cacheDirectory
+from .profiles import DEFAULT_PROFILE, INTERPOLATORS, CurveProfile, profileToDict
+from .profiling import StageTimer
+
+# General smoothing of the measurement map
+MAP_SIGMA = 0.8
+# Additional detail-preserving smoothing of the compensation
+DETAIL_SIGMA = 0.08
+# Edge-preserving smoothing of the compensation
+BILATERAL_DIAMETER = 3
+BILATERAL_SIGMA_COLOR = 0.02
+BILATERAL_SIGMA_SPACE = 3
+
+# Resolution of the lookup table the transfer curve is applied with
+LUT_BINS = 4096
+
+# Width of border region to check and the value under which the border is
+# considered too dark. Sehr hoher Schwellenwert für Randbereiche
+BORDER_WIDTH = 50
+BORDER_THRESHOLD = 0.9
+
+# Fixed-point precision of cv.remap maps and block size of the warps in
+# OpenCV (cv::INTER_BITS, BLOCK_SZ)
+INTER_BITS = 5
+WARP_BLOCK = 32
+# Rows of a warp plan computed at a time and plans kept in memory
+WARP_PLAN_BAND = 256
+WARP_PLAN_MEMORY = 2
+# Size limit of the persistent warp plan cache in MB; the DRLCD_WARP_CACHE_MB
+# environment variable overrides it and 0 disables the cache. Plans are only
+# persisted once they are requested a second time; markers of the plans
+# requested once are kept for this many plans.
+WARP_CACHE_MB = 1024
+WARP_CACHE_MARKERS = 256
+
+def gaussianRadius(sigma: float, truncate: float = 4.0) -> int:
+    """
+    Radius of the kernel scipy.ndimage.gaussian_filter uses for sigma
+    """
+    return int(truncate * float(sigma) + 0.5)
+
+def gaussianKernel(sigma: float) -> np.ndarray:
+    radius = gaussianRadius(sigma)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+class GaussianSmoothing:
+    """
+    Gaussian smoothing as a single float32 separable convolution. Kernels with
+    a radius under one pixel are the identity and are skipped. The "opencv"
+    backend uses cv.sepFilter2D, which runs multithreaded; the "scipy" backend
+    filters strips of the image in a thread pool of `workers` threads. Both
+    mirror the image at its edges like scipy.ndimage (reflect).
+    """
+    BACKENDS = ["opencv", "scipy"]
+
+    def __init__(self, backend: str = "opencv", workers: Optional[int] = None) -> None:
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown smoothing backend {backend}")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+
+    def __call__(self, image: np.ndarray, sigma: float) -> np.ndarray:
+        image = np.asarray(image, dtype=np.float32)
+        if sigma <= 0 or gaussianRadius(sigma) < 1:
+            return image
+        kernel = gaussianKernel(sigma)
+        if self.backend == "opencv":
+            return cv.sepFilter2D(image, cv.CV_32F, kernel, kernel, borderType=cv.BORDER_REFLECT)
+        return self._scipy(image, kernel)
+
+    def _scipy(self, image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+        from scipy.ndimage import correlate1d
+
+        def along(source, axis):
+            # Strips across the filtered axis are independent
+            result = np.empty_like(source)
+            other = 1 - axis
+            bounds = np.linspace(0, source.shape[other], self.workers + 1).astype(int)
+            def run(start, stop):
+                index = (slice(None), slice(start, stop)) if axis == 0 else (slice(start, stop), slice(None))
+                correlate1d(source[index], kernel, axis=axis, output=result[index], mode="reflect")
+            with ThreadPoolExecutor(self.workers) as executor:
+                list(executor.map(run, bounds[:-1], bounds[1:]))
+            return result
+        return along(along(image, 0), 1)
+
+DEFAULT_SMOOTHING = GaussianSmoothing()
+
+class MeasurementStatistics:
+    def __init__(self, data: np.ndarray) -> None:
+        self.min = np.nanmin(data)
+        self.max = np.nanmax(data)
+        self.mean = np.nanmean(data)
+        # Use the 5th percentile as minimum to exclude extreme outliers
+        self.validMin = np.nanpercentile(data, 5)
+
+    def print(self) -> None:
+        print(f"\nMeasurement analysis:")
+        print(f"Raw minimum value: {self.min:.2f} mW")
+        print(f"Valid minimum value (5th percentile): {self.validMin:.2f} mW")
+        print(f"Maximum value: {self.max:.2f} mW")
+        print(f"Mean value: {self.mean:.2f} mW")
+        print(f"Dynamic range: {self.max/self.validMin:.1f}x")
+
+def transferPoints(stats: MeasurementStatistics,
+                   profile: CurveProfile = DEFAULT_PROFILE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Breakpoints of the transfer curve relative to the measured range
+    """
+    rangeMeasured = stats.max - stats.validMin
+    fractions = np.array(profile.fractions)
+    xPoints = stats.validMin + rangeMeasured * fractions
+    # Keep the ends of the range exact
+    xPoints[fractions == 0], xPoints[fractions == 1] = stats.validMin, stats.max
+    return xPoints, np.array(profile.values)
+
+def maskMetadataPath(output: str) -> str:
+    """
+    Path of the JSON sidecar describing how a mask was built
+    """
+    return output + ".json"
+
+def profileOutputPath(output: str, profile: str, batch: bool) -> str:
+    """
+    Output path of the mask for a profile. The path might contain {profile};
+    otherwise the profile name is appended to the file name in batch mode.
+    """
+    if "{profile}" in output:
+        return output.replace("{profile}", profile)
+    if not batch:
+        return output
+    base, ext = os.path.splitext(output)
+    return f"{base}_{profile}{ext}"
+
+def writeMaskMetadata(output: str, metadata: Dict[str, Any]) -> None:
+    with open(maskMetadataPath(output), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+def readMaskMetadata(output: str) -> Dict[str, Any]:
+    with open(maskMetadataPath(output)) as f:
+        return json.load(f)
+
+def screenTransform(corners, screenSize) -> np.ndarray:
+    """
+    Perspective transform mapping the screen corners in the measurement onto
+    the screen of given resolution.
+    """
+    assert len(corners) == 4
+    # Sort corners to ensure X0Y0 is at the black corner
+    sortedCorners = sorted(corners, key=lambda p: (p[0] + p[1]))  # Sort by sum of coordinates
+    expected = sorted([(0, 0), (0, screenSize[1]), (screenSize[0], 0), screenSize],
+                      key=lambda p: (p[0] + p[1]))  # Sort by sum of coordinates
+    return cv.getPerspectiveTransform(np.float32(sortedCorners), np.float32(expected))
+
+class WarpPlan:
+    """
+    Precomputed cv.remap maps of a perspective warp in the fixed-point form of
+    cv.convertMaps: integer source coordinates (CV_16SC2) and the index into
+    the interpolation table (CV_16UC1). Warping with them reproduces
+    cv.warpPerspective(image, transform, screenSize) exactly, also for any
+    band of rows.
+    """
+    def __init__(self, xy: np.ndarray, alpha: np.ndarray) -> None:
+        self.xy = xy
+        self.alpha = alpha
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.alpha.shape[1], self.alpha.shape[0]
+
+    def warp(self, image, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Output rows [start, stop) of the warped image
+        """
+        stop = self.size[1] if stop is None else stop
+        return cv.remap(np.asarray(image), np.asarray(self.xy[start:stop]),
+                        np.asarray(self.alpha[start:stop]), cv.INTER_LINEAR)
+
+def buildWarpPlan(transform: np.ndarray, screenSize, xy: Optional[np.ndarray] = None,
+                  alpha: Optional[np.ndarray] = None, rows: Optional[Tuple[int, int]] = None) -> WarpPlan:
+    """
+    Compute the maps of cv.warpPerspective(image, transform, screenSize) in
+    bands of rows, optionally into preallocated (e.g. memory-mapped) arrays.
+    With rows (first, last), only the maps of output rows [first, last) are
+    computed; they equal those rows of the full plan.
+    """
+    width, height = screenSize
+    first, last = rows if rows is not None else (0, height)
+    xy = np.empty((last - first, width, 2), dtype=np.int16) if xy is None else xy
+    alpha = np.empty((last - first, width), dtype=np.uint16) if alpha is None else alpha
+    _, inverse = cv.invert(transform)
+    m = inverse.ravel()
+    tableSize = 1 << INTER_BITS
+    # cv.warpPerspective works in blocks and evaluates the coordinates
+    # relative to the first column of a block; follow it so they round the
+    # same way
+    blockRows = min(WARP_BLOCK // 2, height)
+    blockWidth = min(WARP_BLOCK * WARP_BLOCK // blockRows, width)
+    # Terms at the first column of every block, spread over its columns, and
+    # the offsets of the columns within their block
+    x1 = np.arange(0, width, blockWidth, dtype=np.float64)
+    counts = np.minimum(blockWidth, width - x1.astype(np.int64))
+    x = (np.arange(width) % blockWidth).astype(np.float64)
+    limits = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+    for start in range(first, last, WARP_PLAN_BAND):
+        stop = min(start + WARP_PLAN_BAND, last)
+        y = np.arange(start, stop, dtype=np.float64)[:, None]
+        w = np.repeat(m[6] * x1 + m[7] * y + m[8], counts, axis=1)
+        w += m[6] * x
+        zero = w == 0
+        np.divide(tableSize, w, out=w, where=~zero)
+        w[zero] = 0
+        fixed = []
+        for a, b, c in [m[0:3], m[3:6]]:
+            f = np.repeat(a * x1 + b * y + c, counts, axis=1)
+            f += a * x
+            f *= w
+            np.clip(f, *limits, out=f)
+            fixed.append(np.rint(f, out=f).astype(np.int32))
+        fx, fy = fixed
+        xy[start - first:stop - first, :, 0] = np.clip(fx >> INTER_BITS, -32768, 32767)
+        xy[start - first:stop - first, :, 1] = np.clip(fy >> INTER_BITS, -32768, 32767)
+        alpha[start - first:stop - first] = (fy & (tableSize - 1)) * tableSize + (fx & (tableSize - 1))
+    return WarpPlan(xy, alpha)
+
+_warpPlans: Dict[str, WarpPlan] = {}
+
+def warpPlanPath(key: str) -> str:
+    return os.path.join(cacheDirectory(), "warp", hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+def warpCacheLimit() -> int:
+    """
+    Size limit of the persistent warp plan cache in bytes
+    """
+    try:
+        return int(float(os.environ.get("DRLCD_WARP_CACHE_MB", WARP_CACHE_MB)) * 1024 * 1024)
+    except ValueError:
+        return WARP_CACHE_MB * 1024 * 1024
+
+def warpPlan(corners, sourceShape, screenSize, cache: bool = True) -> WarpPlan:
+    """
+    The warp plan mapping the measurement onto the screen. Plans are kept in
+    memory and, with cache, plans requested repeatedly (e.g. by later runs and
+    batch workers on the same printer) are stored in memory-mapped files in
+    the cache directory, which is pruned to warpCacheLimit() least recently
+    used first.
+    """
+    screenSize = (int(screenSize[0]), int(screenSize[1]))
+    key = json.dumps(["warp-plan-1", [[float(x), float(y)] for x, y in corners],
+                      list(sourceShape[:2]), list(screenSize)])
+    if key in _warpPlans:
+        return _warpPlans[key]
+    transform = screenTransform(corners, screenSize)
+    width, height = screenSize
+    limit = warpCacheLimit() if cache else 0
+    plan = None
+    if limit > 0:
+        base = warpPlanPath(key)
+        plan = _loadWarpPlan(base, screenSize)
+        if plan is None and width * height * 6 <= limit:
+            if os.path.exists(base + ".seen"):
+                plan = _storeWarpPlan(base, transform, screenSize)
+                if plan is not None:
+                    pruneWarpCache(os.path.dirname(base), limit)
+            else:
+                _touch(base + ".seen")
+    if plan is None:
+        plan = buildWarpPlan(transform, screenSize)
+    while len(_warpPlans) >= WARP_PLAN_MEMORY:
+        del _warpPlans[next(iter(_warpPlans))]
+    _warpPlans[key] = plan
+    return plan
+
+def _touch(path: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a"):
+            os.utime(path)
+    except OSError:
+        pass
+
+def _loadWarpPlan(base: str, screenSize) -> Optional[WarpPlan]:
+    """
+    The cached plan marked as recently used or None
+    """
+    width, height = screenSize
+    try:
+        xy = np.load(base + ".xy.npy", mmap_mode="r")
+        alpha = np.load(base + ".alpha.npy", mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if xy.shape != (height, width, 2) or alpha.shape != (height, width):
+        return None
+    _touch(base + ".xy.npy")
+    _touch(base + ".alpha.npy")
+    return WarpPlan(xy, alpha)
+
+def pruneWarpCache(directory: str, limit: int) -> None:
+    """
+    Remove the least recently used plans until the cache fits into limit
+    bytes and the oldest markers of plans requested only once
+    """
+    plans: Dict[str, List[float]] = {}
+    markers = []
+    try:
+        for entry in os.scandir(directory):
+            name, _, suffix = entry.name.partition(".")
+            stat = entry.stat()
+            if suffix == "seen":
+                markers.append((stat.st_mtime, entry.path))
+            elif suffix.endswith("npy"):
+                record = plans.setdefault(name, [0.0, 0])
+                record[0] = max(record[0], stat.st_mtime)
+                record[1] += stat.st_size
+    except OSError:
+        return
+    total = sum(size for _, size in plans.values())
+    # Stored plans no longer need their marker
+    stale = [path for _, path in markers if os.path.basename(path).partition(".")[0] in plans]
+    markers = [(mtime, path) for mtime, path in markers if path not in stale]
+    stale += [path for _, path in sorted(markers, reverse=True)[WARP_CACHE_MARKERS:]]
+    for name, (_, size) in sorted(plans.items(), key=lambda item: item[1][0]):
+        if total <= limit:
+            break
+        stale += [os.path.join(directory, name + suffix) for suffix in [".xy.npy", ".alpha.npy"]]
+        total -= size
+    for path in stale:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _storeWarpPlan(base: str, transform: np.ndarray, screenSize) -> Optional[WarpPlan]:
+    """
+    Build the plan directly into the cache files; None when they cannot be
+    written
+    """
+    width, height = screenSize
+    try:
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        paths = []
+        for suffix, shape, dtype in [(".xy.npy", (height, width, 2), np.int16),
+                                     (".alpha.npy", (height, width), np.uint16)]:
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(base), suffix=".tmp")
+            os.close(fd)
+            paths.append((tmpPath, base + suffix, shape, dtype))
+        try:
+            arrays = [np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+                      for tmp, _, shape, dtype in paths]
+            buildWarpPlan(transform, screenSize, *arrays)
+            for array in arrays:
+                array.flush()
+            del arrays
+            for tmpPath, target, _, _ in paths:
+                os.replace(tmpPath, target)
+        finally:
+            for tmpPath, _, _, _ in paths:
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+        return WarpPlan(np.load(base + ".xy.npy", mmap_mode="r"),
+                        np.load(base + ".alpha.npy", mmap_mode="r"))
+    except OSError as e:
+        # The cache is only an optimization, never fail because of it
+        print(f"Warning: cannot cache warp plan: {e}")
+        return None
+
+def smoothMap(warped: np.ndarray, fill: float, scale: float = 1.0,
+              smoothing: GaussianSmoothing = DEFAULT_SMOOTHING) -> np.ndarray:
+    # Replace any NaN values with the mean value
+    map = np.nan_to_num(warped, nan=fill)
+    # Apply general smoothing to reduce noise
+    return smoothing(map, MAP_SIGMA * scale)
+
+class TransferLUT:
+    """
+    The transfer curve sampled into a dense lookup table over the measured
+    range. Values outside of the range map to NaN like the spline.
+    """
+    def __init__(self, xPoints: np.ndarray, yPoints: np.ndarray, bins: int = LUT_BINS,
+                 kind: str = DEFAULT_PROFILE.kind, clamp: Tuple[float, float] = DEFAULT_PROFILE.clamp) -> None:
+        self.xPoints = np.asarray(xPoints, dtype=float)
+        self.yPoints = np.asarray(yPoints, dtype=float)
+        self.kind = kind
+        self.clamp = tuple(clamp)
+        self.inputs = np.linspace(self.xPoints[0], self.xPoints[-1], bins)
+        # Create the interpolator (Akima by default) for smooth transitions
+        interpolator = INTERPOLATORS[kind](self.xPoints, self.yPoints)
+        self.outputs = np.clip(interpolator(self.inputs), *self.clamp)  # Ensure values stay within reasonable range
+
+    @property
+    def bins(self) -> int:
+        return len(self.inputs)
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        """
+        Look up the curve for the values (float32); the bins are interpolated
+        linearly with cv.remap using a single-row table.
+        """
+        low, high = self.inputs[0], self.inputs[-1]
+        step = (high - low) / (self.bins - 1)
+        position = np.subtract(values, low - step, dtype=np.float32)
+        position *= np.float32(1 / step)
+        # The table is padded by one bin on both sides to absorb float32
+        # rounding at the ends; out of range is decided on the input values
+        position[~((values >= low) & (values <= high))] = -2
+        table = np.pad(self.outputs.astype(np.float32), 1, mode="edge")
+        # Two identical rows so the vertical interpolation stays inside the table
+        table = np.repeat(table[None, :], 2, axis=0)
+        return cv.remap(table, position, np.zeros_like(position), cv.INTER_LINEAR,
+                        borderMode=cv.BORDER_CONSTANT, borderValue=np.nan)
+
+    def __repr__(self) -> str:
+        return (f"TransferLUT({self.kind}, {self.bins} bins, {self.inputs[0]:.3f}-{self.inputs[-1]:.3f} mW -> "
+                f"{self.outputs.min():.3f}-{self.outputs.max():.3f})")
+
+    def toDict(self) -> dict:
+        return {
+            "bins": self.bins,
+            "kind": self.kind,
+            "clamp": list(self.clamp),
+            "x_points": self.xPoints.tolist(),
+            "y_points": self.yPoints.tolist(),
+            "inputs": [self.inputs[0], self.inputs[-1]],
+            "outputs": self.outputs.tolist()
+        }
+
+    @staticmethod
+    def fromDict(data: dict) -> "TransferLUT":
+        lut = TransferLUT(data["x_points"], data["y_points"], data["bins"],
+                          data.get("kind", DEFAULT_PROFILE.kind), data.get("clamp", DEFAULT_PROFILE.clamp))
+        if "outputs" in data:
+            lut.inputs = np.linspace(*data["inputs"], len(data["outputs"]))
+            lut.outputs = np.array(data["outputs"], dtype=float)
+        return lut
+
+def transferLUT(stats: MeasurementStatistics, profile: CurveProfile = DEFAULT_PROFILE,
+                bins: int = LUT_BINS) -> TransferLUT:
+    return TransferLUT(*transferPoints(stats, profile), bins=bins, kind=profile.kind, clamp=profile.clamp)
+
+def applyTransferCurve(map: np.ndarray, curve: TransferLUT) -> np.ndarray:
+    return curve(map)
+
+def edgePreservingSmooth(compensation: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """
+    Bilateral filter; scale converts the screen pixel parameters to the grid
+    the compensation is computed on.
+    """
+    diameter = 2 * int(BILATERAL_DIAMETER // 2 * scale + 0.5) + 1 if scale != 1.0 else BILATERAL_DIAMETER
+    return cv.bilateralFilter(compensation.astype(np.float32), d=diameter,
+                              sigmaColor=BILATERAL_SIGMA_COLOR, sigmaSpace=BILATERAL_SIGMA_SPACE * scale)
+
+def borderMask(rows: Tuple[int, int], shape: Tuple[int, int],
+               borderWidth: int = BORDER_WIDTH) -> np.ndarray:
+    """
+    Border region of rows [start, stop) of an image with given (height, width)
+    """
+    height, width = shape
+    top, bottom, _ = slice(borderWidth, -borderWidth).indices(height)
+    left, right, _ = slice(borderWidth, -borderWidth).indices(width)
+    rowIdx = np.arange(*rows)[:, None]
+    colIdx = np.arange(width)[None, :]
+    interior = (rowIdx >= top) & (rowIdx < bottom) & (colIdx >= left) & (colIdx < right)
+    return ~interior
+
+def finishCompensation(compensation: np.ndarray, border: np.ndarray,
+                       minValue: int, maxValue: int, scale: float = 1.0,
+                       smoothing: GaussianSmoothing = DEFAULT_SMOOTHING) -> np.ndarray:
+    """
+    Apply the detail smoothing and the border fix and scale the compensation
+    into the output range.
+    """
+    # Additional detail-preserving smoothing with minimal smoothing (skipped
+    # unless the kernel reaches a neighboring pixel)
+    compensation = smoothing(compensation, DETAIL_SIGMA * scale)
+
+    # Set border regions to maximum brightness (1.0) if they are too dark
+    borderValues = compensation[border]
+    compensation[border] = np.where(borderValues < BORDER_THRESHOLD, 1.0, borderValues)
+
+    # Replace any remaining NaN or infinite values with 1.0 (full brightness)
+    compensation = np.nan_to_num(compensation, nan=1.0, posinf=1.0, neginf=1.0)
+
+    # Ensure all values are within valid range before scaling
+    compensation = np.clip(compensation, 0.0, 1.0)
+
+    # Scale to output range (0-255)
+    return minValue + (maxValue - minValue) * compensation
+
+def quantizeMask(compensation: np.ndarray, depth: int = 8) -> np.ndarray:
+    compensation = np.clip(compensation, 0, 255)  # Ensure values are in valid range
+    if depth == 16:
+        # Stretch 0-255 onto 0-65535 so both depths read back the same
+        return np.round(compensation * 257).astype(np.uint16)
+    compensation = np.round(compensation)  # Round to nearest integer
+    return compensation.astype(np.uint8)  # Convert to 8-bit format
+
+def orientMask(mask: np.ndarray) -> np.ndarray:
+    # Rotate the image 180 degrees and flip horizontally
+    mask = cv.rotate(mask, cv.ROTATE_180)
+    return cv.flip(mask, 1)  # Flip horizontally
+
+class CompensationStatistics:
+    """
+    Statistics of the compensation mask accumulated over the whole mask or
+    over tiles of it.
+    """
+    def __init__(self, xPoints: np.ndarray, yPoints: np.ndarray) -> None:
+        self.xPoints = xPoints
+        self.yPoints = yPoints
+        self.pixels = 0
+        self.validCount = 0
+        self.validSum = 0.0
+        self.validMin = np.inf
+        self.validMax = -np.inf
+        self.thresholdPixels = np.zeros(len(xPoints), dtype=np.int64)
+        self.thresholdPower = np.zeros(len(xPoints))
+        self.thresholdCompensation = np.zeros(len(xPoints))
+
+    def update(self, map: np.ndarray, compensation: np.ndarray) -> None:
+        self.pixels += compensation.size
+        validValues = compensation[compensation > 0]
+        if len(validValues) > 0:
+            self.validCount += len(validValues)
+            self.validSum += np.sum(validValues, dtype=np.float64)
+            self.validMin = min(self.validMin, np.min(validValues))
+            self.validMax = max(self.validMax, np.max(validValues))
+        for i, x in enumerate(self.xPoints):
+            mask = map > x
+            self.thresholdPixels[i] += np.sum(mask)
+            self.thresholdPower[i] += np.sum(map[mask], dtype=np.float64)
+            self.thresholdCompensation[i] += np.sum(compensation[mask], dtype=np.float64)
+
+    def print(self) -> None:
+        if self.validCount == 0:
+            print("\nWarning: No valid compensation values found (all values are zero)")
+            return
+        minValid, maxValid = self.validMin, self.validMax
+        print("\nCompensation mask statistics:")
+        print(f"Minimum value: {minValid:.2f} (0-255)")
+        print(f"Maximum value: {maxValid:.2f} (0-255)")
+        print(f"Mean value (average brightness): {self.validSum / self.validCount:.2f} (0-255)")
+        print(f"Compensation range: {maxValid/minValid:.1f}x")
+
+        # Calculate detailed statistics for each threshold
+        print("\nDetailed compensation analysis:")
+        for i, x in enumerate(self.xPoints):
+            pixels = self.thresholdPixels[i]
+            if pixels > 0:
+                avgPower = self.thresholdPower[i] / pixels
+                avgComp = self.thresholdCompensation[i] / pixels
+                print(f"- Areas >{x:3.1f} mW ({pixels/self.pixels*100:4.1f}% of pixels):")
+                print(f"  Avg power: {avgPower:.2f} mW, Avg compensation: {avgComp:.1f}")
+
+        # Calculate and display the impact of compensation
+        strongestDimming = (minValid / 255.0) * 100
+        print(f"\nCompensation impact:")
+        print(f"- Maximum brightness reduction: {100-strongestDimming:.1f}%")
+        print(f"- Compensation thresholds: {min(self.xPoints):.1f} mW to {max(self.xPoints):.1f} mW")
+        print(f"- Compensation range: {min(self.yPoints)*100:.0f}% to 100% of original brightness")
+
+def nativeSize(corners) -> Tuple[int, int]:
+    """
+    Size of the screen in measurement cells given its corners
+    """
+    xs, ys = [p[0] for p in corners], [p[1] for p in corners]
+    return (max(1, int(np.ceil(max(xs) - min(xs)))), max(1, int(np.ceil(max(ys) - min(ys)))))
+
+def resampleToScreen(image: np.ndarray, screenSize) -> np.ndarray:
+    """
+    Bicubic resample of an image whose corners coincide with the screen
+    corners, using the same corner anchoring as screenTransform.
+    """
+    height, width = image.shape
+    scale = np.float64([[width / screenSize[0], 0, 0], [0, height / screenSize[1], 0]])
+    return cv.warpAffine(image.astype(np.float32), scale, screenSize,
+                         flags=cv.INTER_CUBIC | cv.WARP_INVERSE_MAP, borderMode=cv.BORDER_REPLICATE)
+
+def prepareMap(data: np.ndarray, corners, screenSize, stats: MeasurementStatistics,
+               native: bool = False, smoothing: GaussianSmoothing = DEFAULT_SMOOTHING,
+               timer: Optional[StageTimer] = None, warpCache: bool = True) -> Tuple[np.ndarray, float]:
+    """
+    Warp and smooth the measurement. Return the map and the size of its pixel
+    relative to a screen pixel. The map is either in screen pixels or, for
+    native, in measurement cells.
+    """
+    timer = timer or StageTimer()
+    size, scale = screenSize, 1.0
+    if native:
+        size = nativeSize(corners)
+        scale = (size[0] / screenSize[0] + size[1] / screenSize[1]) / 2
+    with timer.stage("plan"):
+        plan = warpPlan(corners, data.shape, size, warpCache)
+    with timer.stage("warp"):
+        warped = plan.warp(data)
+    with timer.stage("smooth"):
+        map = smoothMap(warped, stats.mean, scale, smoothing)
+    return map, scale
+
+def renderMask(map: np.ndarray, scale: float, screenSize, curve: TransferLUT,
+               minValue: int, maxValue: int, smoothing: GaussianSmoothing = DEFAULT_SMOOTHING,
+               timer: Optional[StageTimer] = None, depth: int = 8) -> Tuple[np.ndarray, CompensationStatistics]:
+    """
+    Turn a prepared map into the compensation mask (uint8 or uint16 by depth,
+    not yet oriented for the printer). A map on the measurement grid is resampled to the screen
+    at the end; its statistics refer to the measurement grid.
+    """
+    timer = timer or StageTimer()
+    with timer.stage("curve"):
+        transferred = applyTransferCurve(map, curve)
+    with timer.stage("bilateral"):
+        compensation = edgePreservingSmooth(transferred, scale)
+    with timer.stage("border"):
+        borderWidth = BORDER_WIDTH if scale == 1.0 else max(1, int(np.ceil(BORDER_WIDTH * scale)))
+        border = borderMask((0, map.shape[0]), map.shape, borderWidth)
+        compensation = finishCompensation(compensation, border, minValue, maxValue, scale, smoothing)
+
+    with timer.stage("statistics"):
+        compStats = CompensationStatistics(curve.xPoints, curve.yPoints)
+        compStats.update(map, compensation)
+    if map.shape != (screenSize[1], screenSize[0]):
+        with timer.stage("resample"):
+            compensation = np.clip(resampleToScreen(compensation, screenSize), minValue, maxValue)
+    with timer.stage("quantize"):
+        mask = quantizeMask(compensation, depth)
+    return mask, compStats
+
+def buildMask(data: np.ndarray, corners, screenSize, minValue: int, maxValue: int,
+              stats: MeasurementStatistics, curve: Optional[TransferLUT] = None,
+              smoothing: GaussianSmoothing = DEFAULT_SMOOTHING) -> Tuple[np.ndarray, CompensationStatistics]:
+    """
+    Build the compensation mask (uint8, not yet oriented for the printer) on
+    the full frame.
+    """
+    map, scale = prepareMap(data, corners, screenSize, stats, smoothing=smoothing)
+    return renderMask(map, scale, screenSize, curve or transferLUT(stats), minValue, maxValue, smoothing)
+
+def buildMaskNative(data: np.ndarray, corners, screenSize, minValue: int, maxValue: int,
+                    stats: MeasurementStatistics, curve: Optional[TransferLUT] = None,
+                    smoothing: GaussianSmoothing = DEFAULT_SMOOTHING) -> Tuple[np.ndarray, CompensationStatistics]:
+    """
+    Build the mask on the measurement grid and resample it to the screen once.
+    The filter sizes and the border width are converted from screen pixels to
+    measurement cells.
+    """
+    map, scale = prepareMap(data, corners, screenSize, stats, native=True, smoothing=smoothing)
+    return renderMask(map, scale, screenSize, curve or transferLUT(stats), minValue, maxValue, smoothing)
+
+def _bands(height: int, tileRows: int) -> Iterator[Tuple[int, int]]:
+    for start in range(0, height, tileRows):
+        yield start, min(start + tileRows, height)
+
+def buildMaskTiled(data: np.ndarray, corners, screenSize, minValue: int, maxValue: int,
+                   stats: MeasurementStatistics, curve: Optional[TransferLUT] = None,
+                   tileRows: int = 512, smoothing: GaussianSmoothing = DEFAULT_SMOOTHING,
+                   timer: Optional[StageTimer] = None, depth: int = 8) -> Tuple[np.ndarray, CompensationStatistics]:
+    """
+    Build the same mask as buildMask, byte for byte, while keeping only
+    overlapping row bands of tileRows rows in float32 at a time. The warp
+    maps are computed for each band and never kept or cached as a whole.
+
+    Every band is extended by halo rows covering the reach of the filters. The
+    bilateral filter of OpenCV scales its color weights by the minimum and
+    maximum of the whole image, so a first pass collects them and every band is
+    filtered with a sentinel row carrying them.
+    """
+    timer = timer or StageTimer()
+    width, height = screenSize
+    curve = curve or transferLUT(stats)
+    transform = screenTransform(corners, screenSize)
+    mapHalo = gaussianRadius(MAP_SIGMA)
+    bilateralHalo = BILATERAL_DIAMETER // 2
+    detailHalo = gaussianRadius(DETAIL_SIGMA)
+
+    def curveRows(start, stop):
+        """
+        Smoothed map and transfer curve output for rows [start, stop)
+        """
+        warpStart, warpStop = max(0, start - mapHalo), min(height, stop + mapHalo)
+        with timer.stage("plan"):
+            plan = buildWarpPlan(transform, screenSize, rows=(warpStart, warpStop))
+        with timer.stage("warp"):
+            warped = plan.warp(data)
+        with timer.stage("smooth"):
+            map = smoothMap(warped, stats.mean, smoothing=smoothing)[start - warpStart:stop - warpStart]
+        with timer.stage("curve"):
+            transferred = applyTransferCurve(map, curve).astype(np.float32)
+        return map, transferred
+
+    # First pass: the value range the bilateral filter sees on the full frame
+    low, high = np.inf, -np.inf
+    for start, stop in _bands(height, tileRows):
+        _, transferred = curveRows(start, stop)
+        if np.any(~np.isnan(transferred)):
+            low = min(low, np.nanmin(transferred))
+            high = max(high, np.nanmax(transferred))
+
+    mask = np.empty((height, width), dtype=np.uint16 if depth == 16 else np.uint8)
+    compStats = CompensationStatistics(curve.xPoints, curve.yPoints)
+    halo = bilateralHalo + detailHalo
+    for start, stop in _bands(height, tileRows):
+        haloStart, haloStop = max(0, start - halo), min(height, stop + halo)
+        map, transferred = curveRows(haloStart, haloStop)
+
+        with timer.stage("bilateral"):
+            # Mirror rows at the frame edges like the filter does (reflect 101)
+            # and append the sentinel row below the halo
+            padTop = bilateralHalo if haloStart == 0 else 0
+            padBottom = bilateralHalo if haloStop == height else 0
+            padded = cv.copyMakeBorder(transferred, padTop, padBottom, 0, 0, cv.BORDER_REFLECT_101)
+            sentinel = np.full((bilateralHalo + 1, width), high, dtype=np.float32)
+            sentinel[-1, 0] = low
+            smoothed = edgePreservingSmooth(np.vstack([padded, sentinel]))
+            smoothed = smoothed[padTop:padTop + (haloStop - haloStart)]
+
+        with timer.stage("border"):
+            border = borderMask((haloStart, haloStop), (height, width))
+            compensation = finishCompensation(smoothed, border, minValue, maxValue, smoothing=smoothing)
+        inner = slice(start - haloStart, stop - haloStart)
+        with timer.stage("statistics"):
+            compStats.update(map[inner], compensation[inner])
+        with timer.stage("quantize"):
+            mask[start:stop] = quantizeMask(compensation[inner], depth)
+    return mask, compStats
+
+class MaskResult(NamedTuple):
+    output: str
+    profile: str
+    minimum: float  # Statistics of the mask values (0-255) above zero
+    maximum: float
+    mean: float
+    size: int  # File size in bytes
+    seconds: float  # Time to render and write the mask
+    encodeSeconds: float  # Time to encode and write the file
+
+# Encoder presets trading file size for speed. RLE is nearly as small as the
+# filtered strategy on smooth masks at a fraction of the time of level 9
+PNG_PRESETS = {
+    "fast": [cv.IMWRITE_PNG_COMPRESSION, 1, cv.IMWRITE_PNG_STRATEGY, cv.IMWRITE_PNG_STRATEGY_RLE],
+    "balanced": [cv.IMWRITE_PNG_COMPRESSION, 6, cv.IMWRITE_PNG_STRATEGY, cv.IMWRITE_PNG_STRATEGY_FILTERED],
+    "smallest": [cv.IMWRITE_PNG_COMPRESSION, 9, cv.IMWRITE_PNG_STRATEGY, cv.IMWRITE_PNG_STRATEGY_FILTERED]
+}
+# None, LZW and Deflate
+TIFF_PRESETS = {"fast": 1, "balanced": 5, "smallest": 8}
+DEFAULT_PRESET = "smallest"
+
+def maskFormat(output: str) -> str:
+    """
+    Format of the mask file by its extension: png, tiff or raw (headerless
+    little-endian pixels, row by row). Other extensions are left to OpenCV.
+    """
+    extension = os.path.splitext(output)[1].lower()
+    return {".tif": "tiff", ".tiff": "tiff", ".raw": "raw"}.get(extension, extension.lstrip(".") or "png")
+
+def writeMask(output: str, mask: np.ndarray, preset: str = DEFAULT_PRESET) -> None:
+    format = maskFormat(output)
+    if format == "raw":
+        mask.astype(mask.dtype.newbyteorder("<"), copy=False).tofile(output)
+        return
+    if format == "tiff":
+        params = [cv.IMWRITE_TIFF_COMPRESSION, TIFF_PRESETS[preset]]
+    else:
+        params = PNG_PRESETS[preset] + [cv.IMWRITE_PNG_BILEVEL, 0]
+    if not cv.imwrite(output, mask, params):
+        raise OSError(f"Cannot write mask {output}")
+
+def defaultCorners(data: np.ndarray) -> List[Tuple[int, int]]:
+    return [(0, 0), (0, data.shape[0]), (data.shape[1], 0), (data.shape[1], data.shape[0])]
+
+def compensateMeasurement(data: np.ndarray, measurement: str, output: str, screenSize,
+                          minValue: int = 0, maxValue: int = 255, corners=None,
+                          pipeline: str = "screen", tileRows: int = 0,
+                          profiles: Optional[List[CurveProfile]] = None,
+                          smoothing: GaussianSmoothing = DEFAULT_SMOOTHING,
+                          timer: Optional[StageTimer] = None,
+                          verbose: bool = True, preset: str = DEFAULT_PRESET,
+                          depth: int = 8, warpCache: bool = True) -> List[MaskResult]:
+    """
+    Build, orient and write the masks for a measurement, one per profile, each
+    with its metadata sidecar. The warped map is shared by all profiles unless
+    processing in bands. Time spent in the stages is accumulated in the timer.
+    The masks are encoded with the preset in the given bit depth (8 or 16).
+    Without warpCache, warp plans are not stored in the cache directory; tiled
+    processing never caches them.
+    """
+    if preset not in PNG_PRESETS:
+        raise ValueError(f"Unknown encoder preset {preset}, choose from {', '.join(PNG_PRESETS)}")
+    if depth not in (8, 16):
+        raise ValueError(f"Unsupported bit depth {depth}, use 8 or 16")
+    timer = timer or StageTimer()
+    profiles = profiles or [DEFAULT_PROFILE]
+    corners = corners or defaultCorners(data)
+
+    # Analyze measurement values
+    with timer.stage("analyze"):
+        stats = MeasurementStatistics(data)
+    if verbose:
+        stats.print()
+
+    tiled = tileRows > 0 and pipeline != "native"
+    if not tiled:
+        map, scale = prepareMap(data, corners, screenSize, stats, pipeline == "native",
+                                smoothing, timer, warpCache)
+
+    results = []
+    for profile in profiles:
+        start = time.perf_counter()
+        curve = transferLUT(stats, profile)
+        if verbose:
+            print(f"\nProfile {profile.name}, transfer curve: {curve}")
+        if tiled:
+            mask, compStats = buildMaskTiled(data, corners, screenSize, minValue, maxValue,
+                                             stats, curve, tileRows, smoothing, timer, depth)
+        else:
+            mask, compStats = renderMask(map, scale, screenSize, curve, minValue, maxValue,
+                                         smoothing, timer, depth)
+        if verbose:
+            compStats.print()
+
+        profileOutput = profileOutputPath(output, profile.name, len(profiles) > 1)
+        with timer.stage("orient"):
+            mask = orientMask(mask)
+        encodeStart = time.perf_counter()
+        with timer.stage("encode"):
+            writeMask(profileOutput, mask, preset)
+        encodeSeconds = time.perf_counter() - encodeStart
+        writeMaskMetadata(profileOutput, {
+            "measurement": os.path.abspath(measurement),
+            "screen": list(screenSize),
+            "corners": [[float(x) for x in c] for c in corners],
+            "min": minValue,
+            "max": maxValue,
+            "pipeline": pipeline,
+            "smoothing": smoothing.backend,
+            "profile": {"name": profile.name, **profileToDict(profile)},
+            "transfer": curve.toDict(),
+            "encoding": {
+                "format": maskFormat(profileOutput),
+                "preset": preset,
+                "depth": depth,
+                "shape": list(mask.shape)
+            }
+        })
+
+        # Print file size information
+        fileSize = os.path.getsize(profileOutput)
+        if verbose:
+            print(f"\nOutput file {profileOutput} size: {fileSize / 1024:.1f} KB, "
+                  f"encoded in {encodeSeconds * 1000:.0f} ms ({preset}, {depth} bit)")
+        mean = compStats.validSum / compStats.validCount if compStats.validCount else float("nan")
+        results.append(MaskResult(profileOutput, profile.name, float(compStats.validMin),
+                                  float(compStats.validMax), mean, fileSize,
+                                  time.perf_counter() - start, encodeSeconds))
+    return results
@@ -1,52 +1,68 @@
-import math
-from typing import List
-import plotly.graph_objects as go
-import click
 import json
+from typing import List, Optional, Tuple
+import click
 import numpy as np
 import cv2 as cv
-import itertools
-from scipy.ndimage.filters import gaussian_filter
-from scipy.interpolate import Akima1DInterpolator
-from .ui_common import Resolution
+from .ui_common import Corners, Resolution
+from .io import fileDigest, loadMeasurement
 import os
 
 def replacePeaks(arr: np.array, threshold: float, windowSize: int):
     """
     Given an array and threshold, replace peaks with local average of
     windowSize×windowSize.
+
+    The local average excludes all window cells equal to the peak value and
+    missing (NaN) cells. The window is clipped at the array border, so border
+    cells are filtered too. Peaks without any valid differing neighbor and
+    missing cells are left untouched.
     """
+    arr = np.asarray(arr, dtype=float)
     result = np.copy(arr)
     height, width = arr.shape
 
     halfWindow = windowSize // 2
+    peaks = arr > threshold
+    if not peaks.any():
+        return result
 
-    for i in range(halfWindow, height - halfWindow):
-        for j in range(halfWindow, width - halfWindow):
-            if arr[i, j] > threshold:
-                localWindow = arr[i - halfWindow: i + halfWindow + 1, j - halfWindow: j + halfWindow + 1]
-                localWindowWithoutPeak = localWindow[localWindow != arr[i, j]]
-                localAverage = np.mean(localWindowWithoutPeak)
-                result[i, j] = localAverage
+    # Accumulate the window sums by shifting a padded copy of the array over
+    # the peaks; the loop runs over window offsets, not over cells.
+    padded = np.pad(arr, halfWindow)
+    inside = np.pad(np.ones(arr.shape, dtype=bool), halfWindow)
+    peakValues = arr[peaks]
+    sums = np.zeros_like(peakValues)
+    counts = np.zeros(peakValues.shape, dtype=np.int64)
+    for dy in range(2 * halfWindow + 1):
+        for dx in range(2 * halfWindow + 1):
+            neighbors = padded[dy:dy + height, dx:dx + width][peaks]
+            valid = inside[dy:dy + height, dx:dx + width][peaks] & (neighbors != peakValues) \
+                & ~np.isnan(neighbors)
+            sums += np.where(valid, neighbors, 0)
+            counts += valid
 
+    replaceable = counts > 0
+    result[peaks] = np.where(replaceable, sums / np.maximum(counts, 1), peakValues)
     return result
 
-def normalizeData(data: List[List[dict]], lowThreshold=0) -> List[List[float]]:
-    # Extract just the values from the measurement dictionaries
-    values = [[point['value'] for point in row] for row in data]
-    
-    # Convert to numpy array
-    npArray = np.array(values)
+def normalizeData(values: np.ndarray, lowThreshold=0) -> np.ndarray:
+    """
+    Filter peaks and hide values at or below lowThreshold as NaN. Missing
+    measurement points stay NaN.
+    """
+    npArray = np.array(values, dtype=float)
+    if np.isnan(npArray).all():
+        return npArray
 
     # There are often faulty peaks in the source data, let's filter them out
-    mean = np.mean(npArray)
+    mean = np.nanmean(npArray)
     npArray = replacePeaks(npArray, 1.5 * mean, 3)
 
-    max = np.max(npArray)
+    max = np.nanmax(npArray)
     npArray = np.clip(npArray, lowThreshold, max)
     npArray[npArray == lowThreshold] = None
 
-    return npArray.tolist()
+    return npArray
 
 @click.command()
 @click.argument("input", type=click.Path())
@@ -57,142 +73,423 @@ def normalizeData(data: List[List[dict]], lowThreshold=0) -> List[List[float]]:
     help="Immediately show")
 @click.option("--threshold", type=int, default=0,
     help="Minimal value to crop")
-def visualize(input, output, title, show, threshold):
-    with open(input) as f:
-        measurement = json.load(f)
-    data = normalizeData(measurement["measurements"], lowThreshold=threshold)
+@click.option("--max-cells", type=int, default=0,
+    help="Pool the grid to at most this many cells and add a heatmap view (0 = full resolution surface only)")
+@click.option("--pooling", type=click.Choice(["mean", "max"]), default="mean",
+    help="How --max-cells combines the cells of a block")
+@click.option("--tiles", type=click.Path(file_okay=False),
+    help="Write full resolution tiles to this directory; the heatmap loads them when zoomed in "
+         "to at most --max-cells cells (serve the HTML over HTTP)")
+@click.option("--profile-stages", "profile_stages", type=click.Path(dir_okay=False),
+    help="Write wall time, CPU time and peak memory of each stage to this JSON report")
+def visualize(input, output, title, show, threshold, max_cells, pooling, tiles, profile_stages):
+    """
+    Plot a measurement as an interactive 3D surface in a standalone HTML file.
+    The grid is embedded as base64 typed arrays. For dense scans, --max-cells
+    embeds a pooled surface and heatmap instead of the full grid.
+    """
+    from .profiling import StageTimer
+
+    if tiles and max_cells <= 0:
+        raise click.UsageError("--tiles requires --max-cells")
+
+    timer = StageTimer(memory=profile_stages is not None)
+    with timer.stage("load"):
+        measurement = loadMeasurement(input)
+        data = normalizeData(measurement.values, lowThreshold=threshold)
     
     # Calculate statistics
-    np_data = np.array(data)
-    min_val = np.nanmin(np_data)
-    max_val = np.nanmax(np_data)
-    avg_val = np.nanmean(np_data)
+    with timer.stage("statistics"):
+        min_val = np.nanmin(data)
+        max_val = np.nanmax(data)
+        avg_val = np.nanmean(data)
     
     # Add statistics to title
     stats_title = f"{title}<br>Min: {min_val:.3f} | Max: {max_val:.3f} | Avg: {avg_val:.3f}"
+
+    height, width = data.shape
+    if max_cells > 0:
+        from .lod import blockCenters, lodFactor, poolGrid
+        with timer.stage("pooling"):
+            factor = lodFactor(data.shape, max_cells)
+            z = poolGrid(data, factor, pooling)
+            x, y = blockCenters(width, factor), blockCenters(height, factor)
+        print(f"Embedding {z.shape[1]}x{z.shape[0]} cells ({pooling} of {factor}x{factor} blocks) "
+              f"of the {width}x{height} grid")
     
     # Create figure with proper orientation
-    fig = go.Figure(data=[go.Surface(z=data)])
+    with timer.stage("figure"):
+        import plotly.graph_objects as go
+        if max_cells > 0:
+            from plotly.subplots import make_subplots
+            fig = make_subplots(rows=1, cols=2, specs=[[{"type": "scene"}, {"type": "xy"}]])
+            fig.add_trace(go.Surface(z=z, x=x, y=y, cmin=min_val, cmax=max_val, showscale=False), row=1, col=1)
+            fig.add_trace(go.Heatmap(z=z, x=x, y=y, zmin=min_val, zmax=max_val), row=1, col=2)
+            fig.update_yaxes(autorange="reversed", scaleanchor="x", row=1, col=2)
+        else:
+            fig = go.Figure(data=[go.Surface(z=data)])
     
-    # Update layout to ensure X0Y0 is at top left
-    fig.update_layout(
-        title=stats_title,
-        autosize=True,
-        scene=dict(
-            aspectmode="manual",
-            aspectratio=dict(x=1, y=measurement["resolution"][1]/measurement["resolution"][0], z=0.1),
-            camera=dict(
-                up=dict(x=0, y=0, z=1),
-                center=dict(x=0, y=0, z=0),
-                eye=dict(x=1.5, y=1.5, z=1.5)
-            ),
-            xaxis=dict(
-                title='X',
-                range=[0, len(data[0])-1],
-                autorange='reversed'  # Reverse X axis to match X0Y0 at top left
-            ),
-            yaxis=dict(
-                title='Y',
-                range=[0, len(data)-1]
-            ),
-            zaxis=dict(
-                title='Brightness'
+        # Update layout to ensure X0Y0 is at top left
+        fig.update_layout(
+            title=stats_title,
+            autosize=True,
+            scene=dict(
+                aspectmode="manual",
+                aspectratio=dict(x=1, y=measurement.resolution[1]/measurement.resolution[0], z=0.1),
+                camera=dict(
+                    up=dict(x=0, y=0, z=1),
+                    center=dict(x=0, y=0, z=0),
+                    eye=dict(x=1.5, y=1.5, z=1.5)
+                ),
+                xaxis=dict(
+                    title='X',
+                    range=[0, width-1],
+                    autorange='reversed'  # Reverse X axis to match X0Y0 at top left
+                ),
+                yaxis=dict(
+                    title='Y',
+                    range=[0, height-1]
+                ),
+                zaxis=dict(
+                    title='Brightness'
+                )
             )
         )
-    )
     
-    fig.write_html(output)
+    with timer.stage("write"):
+        postScript = None
+        if tiles:
+            from .lod import tileLoaderScript, writeTiles
+            writeTiles(data, tiles)
+            url = os.path.relpath(tiles, os.path.dirname(os.path.abspath(output))).replace(os.sep, "/")
+            postScript = tileLoaderScript(data.shape, url, max_cells, trace=1)
+        fig.write_html(output, post_script=postScript)
+    if profile_stages:
+        timer.writeReport(profile_stages, "visualize", {
+            "input": input,
+            "output": output,
+            "max_cells": max_cells,
+            "pooling": pooling,
+            "tiles": tiles
+        })
     if show:
         fig.show()
 
-def lineIntersection(line1, line2):
+# Hough lines closer than this are the same line
+LINE_RHO_TOLERANCE = 10
+LINE_THETA_TOLERANCE = np.pi / 40
+# Only the strongest Hough lines are clustered
+MAX_HOUGH_LINES = 512
+# Lines meeting at a smaller angle do not form a corner
+MIN_CORNER_ANGLE = np.pi / 8
+# Screen edges on opposite sides differ at most by this angle
+PARALLEL_TOLERANCE = np.pi / 6
+# Contour points used to score the quadrilaterals
+MAX_SCORE_POINTS = 2000
+# Quadrilaterals scoring worse than this do not outline the screen
+MAX_QUAD_SCORE = 0.25
+# Size of the outline the Hough transform runs on; finer angle steps on the
+# full outline of large images cost seconds
+HOUGH_SIZE = 512
+# Contour points within this many Hough pixels from an edge refine the edge
+EDGE_BAND = 3
+# Cells searched on both sides of an edge and the profile step for the
+# sub-pixel refinement
+EDGE_SEARCH = 3
+EDGE_STEP = 0.125
+# Profiles with less contrast than this fraction of the value range do not
+# cross a screen edge
+MIN_EDGE_CONTRAST = 0.25
+
+def clusterLines(lines: np.ndarray, rhoTolerance: float = LINE_RHO_TOLERANCE,
+                 thetaTolerance: float = LINE_THETA_TOLERANCE) -> np.ndarray:
     """
-    Finds the intersection of two lines given in Hesse normal form.
+    Reduce Hough lines (rho, theta), strongest first, to the strongest line of
+    every cluster: a line is dropped when it is close to a stronger line that
+    is kept. Lines with theta near 0 and near pi are compared with the normal
+    flipped.
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    rho, theta = lines[:, 0], lines[:, 1]
+    dRho = rho[:, None] - rho[None, :]
+    sRho = rho[:, None] + rho[None, :]
+    dTheta = np.abs(theta[:, None] - theta[None, :])
+    close = (np.abs(dRho) < rhoTolerance) & (dTheta < thetaTolerance)
+    close |= (np.abs(sRho) < rhoTolerance) & (np.abs(dTheta - np.pi) < thetaTolerance)
+    remaining = np.ones(len(lines), dtype=bool)
+    keep = []
+    while remaining.any():
+        i = int(np.argmax(remaining))
+        keep.append(i)
+        remaining &= ~close[i]
+    return lines[keep]
 
-    Returns closest integer pixel locations.
-    See https://stackoverflow.com/a/383527/5087436
+def intersectLines(lines: np.ndarray, minAngle: float = MIN_CORNER_ANGLE) -> np.ndarray:
     """
-    rho1, theta1 = line1
-    rho2, theta2 = line2
-    A = np.array([
-        [np.cos(theta1), np.sin(theta1)],
-        [np.cos(theta2), np.sin(theta2)]
-    ])
-    b = np.array([[rho1], [rho2]])
-    try:
-        x0, y0 = np.linalg.solve(A, b)
-    except np.linalg.LinAlgError:
+    Intersections of all pairs of lines (rho, theta) in Hesse normal form as a
+    (n, n, 2) array of (x, y); pairs meeting at less than minAngle are NaN.
+    All 2x2 systems are solved at once.
+    """
+    n = len(lines)
+    i, j = np.triu_indices(n, 1)
+    normals = np.stack([np.cos(lines[:, 1]), np.sin(lines[:, 1])], axis=1)
+    A = np.stack([normals[i], normals[j]], axis=1)
+    b = np.stack([lines[i, 0], lines[j, 0]], axis=1)
+    # The determinant is the sine of the angle between the lines
+    valid = np.abs(np.linalg.det(A)) > np.sin(minAngle)
+    points = np.full((len(i), 2), np.nan)
+    if valid.any():
+        points[valid] = np.linalg.solve(A[valid], b[valid][..., None])[..., 0]
+    result = np.full((n, n, 2), np.nan)
+    result[i, j] = points
+    result[j, i] = points
+    return result
+
+def quadCandidates(lines: np.ndarray) -> np.ndarray:
+    """
+    Indices (a, b, c, d) of line quadruples where a, b and c, d are roughly
+    parallel pairs and the two pairs cross; the quadrilateral has the corners
+    a×c, a×d, b×d, b×c.
+    """
+    theta = lines[:, 1]
+    i, j = np.triu_indices(len(lines), 1)
+    angle = np.abs(theta[i] - theta[j])
+    angle = np.minimum(angle, np.pi - angle)
+    parallel = angle < PARALLEL_TOLERANCE
+    pairs = np.stack([i[parallel], j[parallel]], axis=1)
+    p, q = np.triu_indices(len(pairs), 1)
+    direction = np.abs(theta[pairs[p, 0]] - theta[pairs[q, 0]])
+    direction = np.minimum(direction, np.pi - direction)
+    crossing = direction > MIN_CORNER_ANGLE
+    return np.concatenate([pairs[p[crossing]], pairs[q[crossing]]], axis=1)
+
+def fitLine(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Total least squares line through the points as its centroid and unit
+    normal
+    """
+    center = points.mean(axis=0)
+    _, vectors = np.linalg.eigh(np.cov((points - center).T))
+    return center, vectors[:, 0]  # Smallest eigenvalue
+
+def orderCorners(points) -> List[Tuple[float, float]]:
+    """
+    Order four corners like defaultCorners: top left, bottom left, top right,
+    bottom right
+    """
+    quad = np.float64(points)
+    total, difference = quad.sum(axis=1), quad[:, 1] - quad[:, 0]
+    topLeft, bottomRight = np.argmin(total), np.argmax(total)
+    rest = [k for k in range(4) if k not in (topLeft, bottomRight)]
+    bottomLeft = max(rest, key=lambda k: difference[k])
+    topRight = min(rest, key=lambda k: difference[k])
+    return [(float(quad[k, 0]), float(quad[k, 1])) for k in [topLeft, bottomLeft, topRight, bottomRight]]
+
+def fitEdges(points: np.ndarray, lines: np.ndarray, band: float) -> np.ndarray:
+    """
+    Refine lines (rho, theta) by a total least squares fit to the points
+    nearest to each line within band. Lines with too few points are kept.
+    """
+    normals = np.stack([np.cos(lines[:, 1]), np.sin(lines[:, 1])])
+    distances = np.abs(points @ normals - lines[:, 0])
+    nearest = np.argmin(distances, axis=1)
+    refined = lines.copy()
+    for k in range(len(lines)):
+        selected = points[(nearest == k) & (distances[:, k] < band)]
+        if len(selected) < 3:
+            continue
+        center, normal = fitLine(selected)
+        if normal @ normals[:, k] < 0:
+            normal = -normal
+        refined[k] = (center @ normal, np.arctan2(normal[1], normal[0]))
+    return refined
+
+def screenCornersFromLines(lines: np.ndarray, contour: np.ndarray, shape,
+                           band: float = EDGE_BAND) -> Optional[List[Tuple[float, float]]]:
+    """
+    Pick the quadrilateral of Hough lines that best outlines the contour of
+    the screen. The score adds the relative difference of the areas and the
+    mean distance of the contour points from the quadrilateral relative to
+    its size. The edges of the best one are fitted to the contour points
+    within band. Returns the corners ordered like defaultCorners or None.
+    """
+    lines = clusterLines(lines[:MAX_HOUGH_LINES])
+    quads = quadCandidates(lines)
+    if len(quads) == 0:
+        return None
+    points = intersectLines(lines)
+    a, b, c, d = quads.T
+    corners = np.stack([points[a, c], points[a, d], points[b, d], points[b, c]], axis=1)
+    height, width = shape
+    inside = np.all(np.isfinite(corners), axis=(1, 2)) & \
+        np.all((corners[..., 0] >= -1) & (corners[..., 0] <= width) &
+               (corners[..., 1] >= -1) & (corners[..., 1] <= height), axis=1)
+    if not inside.any():
         return None
-    x0, y0 = int(np.round(x0)), int(np.round(y0))
-    return (x0, y0)
+    quads, corners = quads[inside], corners[inside]
+
+    x, y = corners[..., 0], corners[..., 1]
+    area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1))
+    contourArea = max(cv.contourArea(contour.astype(np.float32)), 1.0)
+    contour = contour.reshape(-1, 2).astype(np.float64)
+    sampled = contour[::max(1, len(contour) // MAX_SCORE_POINTS)]
+    # Distance of every contour point from every line; the distance from a
+    # quadrilateral is the one from its nearest edge
+    distances = np.abs(sampled @ np.stack([np.cos(lines[:, 1]), np.sin(lines[:, 1])]) - lines[:, 0])
+    edgeDistance = distances[:, quads].min(axis=2).mean(axis=0)
+    score = np.abs(area - contourArea) / contourArea + edgeDistance / np.sqrt(contourArea)
+    best = int(np.argmin(score))
+    if score[best] > MAX_QUAD_SCORE:
+        return None
+
+    edges = fitEdges(contour, lines[quads[best]], band)
+    points = intersectLines(edges, 0)
+    quad = np.stack([points[0, 2], points[0, 3], points[1, 3], points[1, 2]])
+    if not np.all(np.isfinite(quad)):
+        quad = corners[best]
+    return orderCorners(quad)
 
-def locateScreenAutomatic(image, threshold):
-    npImg = np.array(image)
-    ret, thresholded = cv.threshold(npImg, threshold, 255, cv.THRESH_BINARY)
+def locateScreenAutomatic(image, threshold) -> Optional[List[Tuple[float, float]]]:
+    """
+    Locate the corners of the screen, the largest region brighter than the
+    threshold, as intersections of the Hough lines along its outline refined
+    to sub-pixel precision. Returns None when no quadrilateral fits the
+    outline.
+    """
+    npImg = np.asarray(image, dtype=np.float32)
+    _, thresholded = cv.threshold(npImg, threshold, 255, cv.THRESH_BINARY)
     thresholded = np.uint8(thresholded)
 
-    contours, hierarchy = cv.findContours(thresholded, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-
-    # We draw contours to find lines in the using Hough transform
-    countoursImg = np.zeros((len(image), len(image[0])), dtype=np.uint8)
-    cv.drawContours(countoursImg, contours, 0, 255,  1)
-
-    # Detect the lines
-    lines = cv.HoughLines(countoursImg, 0.5, np.pi / 360, len(image[0]) // 5, None, 0, 0, 0, 3 / 4 * np.pi)
-    dbgImg1 = cv.cvtColor(countoursImg, cv.COLOR_GRAY2RGB)
-
-    def thetaClose(a, b):
-        return abs(a - b) < np.pi / 40
-
-    def rhoClose(a, b):
-        return abs(a - b) < 10
-
-    if lines is not None:
-        # Find strong lines
-        strongLines = []
-        for line in lines:
-            rho, theta = line[0][0], line[0][1]
-            if any(rhoClose(rho, l[0]) and thetaClose(theta, l[1]) for l in strongLines):
-                continue
-            strongLines.append((rho, theta))
-
-        # Draw lines into dbg image:
-        for line in strongLines:
-            rho, theta = line[0], line[1]
-            a = math.cos(theta)
-            b = math.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            pt1 = (int(x0 + 1000*(-b)), int(y0 + 1000*(a)))
-            pt2 = (int(x0 - 1000*(-b)), int(y0 - 1000*(a)))
-            cv.line(dbgImg1, pt1, pt2, (255,0,255), 1, cv.LINE_AA)
-
-    intersections = [lineIntersection(l1, l2) for l1, l2 in itertools.product(strongLines, strongLines) if l1 != l2]
-    fitsInImage = lambda p: p[0] > 0 and p[0] <= len(image[0]) and p[1] > 0 and p[1] <= len(image)
-    corners = list(set([x for x in intersections if x is not None and fitsInImage(x)]))
-    return corners
+    contours, _ = cv.findContours(thresholded, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    if not contours:
+        return None
+    contour = max(contours, key=cv.contourArea)
 
-def originDistance(point):
-    return point[0] ** 2 + point[1] ** 2
+    # We draw the outline to find lines in it using Hough transform
+    scale = min(1.0, HOUGH_SIZE / max(npImg.shape))
+    size = (max(1, round(npImg.shape[1] * scale)), max(1, round(npImg.shape[0] * scale)))
+    outline = np.zeros((size[1], size[0]), dtype=np.uint8)
+    cv.polylines(outline, [np.round(contour * scale).astype(np.int32)], True, 255, 1)
+    # Lines along a fifth of the shorter side; slanted edges get fewer votes
+    lines = cv.HoughLines(outline, 0.5, np.pi / 360, max(2, min(size) // 5), None, 0, 0, 0, np.pi)
+    if lines is None:
+        return None
+    lines = lines.reshape(-1, 2).astype(np.float64)
+    lines[:, 0] /= scale
+    corners = screenCornersFromLines(lines, contour, npImg.shape, EDGE_BAND / scale)
+    return refineCorners(npImg, corners) if corners is not None else None
 
-def cropToScreen(image, corners, screenSize):
-    assert len(corners) == 4
+def refineCorners(image, corners, search: float = EDGE_SEARCH) -> List[Tuple[float, float]]:
+    """
+    Refine screen corners to sub-pixel precision. Every edge is sampled by
+    intensity profiles across it; the edge passes through the points where
+    the profiles cross halfway between their inner and outer values. The
+    corners are intersections of lines fitted to these points. Edges without
+    contrast, e.g. where the screen reaches the end of the scan, are kept.
+
+    Corners are in the coordinates of defaultCorners, where cell i spans
+    [i, i + 1].
+    """
+    values = np.asarray(image, dtype=np.float32)
+    finite = values[np.isfinite(values)]
+    contrast = MIN_EDGE_CONTRAST * float(finite.max() - finite.min()) if finite.size else 0.0
+    # Walk around the quadrilateral: top left, top right, bottom right, bottom left
+    around = np.float64(orderCorners(corners))[[0, 2, 3, 1]]
+    middle = around.mean(axis=0)
+    steps = np.arange(-search, search + EDGE_STEP / 2, EDGE_STEP)
+
+    edges = []
+    for k in range(4):
+        start, end = around[k], around[(k + 1) % 4]
+        length = max(float(np.hypot(*(end - start))), 1e-9)
+        normal = np.array([start[1] - end[1], end[0] - start[0]]) / length
+        if normal @ (start - middle) < 0:
+            normal = -normal  # Point outwards
+        t = np.linspace(0.1, 0.9, max(8, int(length)))
+        samples = start + t[:, None, None] * (end - start) + steps[None, :, None] * normal
+        # Sample at cell centers, which sit at i + 0.5
+        samples = (samples - 0.5).astype(np.float32)
+        profiles = cv.remap(values, samples[..., 0], samples[..., 1], cv.INTER_LINEAR,
+                            borderMode=cv.BORDER_CONSTANT, borderValue=np.nan)
+        inner, outer = profiles[:, 0], profiles[:, -1]
+        level = (inner + outer) / 2
+        above = profiles > level[:, None]
+        crossings = above[:, :-1] & ~above[:, 1:]
+        # The crossing nearest to the current edge
+        index = np.where(crossings, np.abs(steps[:-1]), np.inf).argmin(axis=1)
+        rows = np.arange(len(t))
+        before, after = profiles[rows, index], profiles[rows, index + 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            offset = steps[index] + (before - level) / (before - after) * EDGE_STEP
+        valid = np.all(np.isfinite(profiles), axis=1) & (inner - outer > contrast) & \
+            crossings.any(axis=1) & np.isfinite(offset)
+        if valid.sum() < 3:
+            edges.append((start, normal))
+            continue
+        points = start + t[valid, None] * (end - start) + offset[valid, None] * normal
+        edges.append(fitLine(points))
 
-    npImg = np.array(image)
+    refined = []
+    for k in range(4):
+        (c1, n1), (c2, n2) = edges[k - 1], edges[k]
+        A = np.stack([n1, n2])
+        if abs(np.linalg.det(A)) < np.sin(MIN_CORNER_ANGLE):
+            refined.append(around[k])
+            continue
+        refined.append(np.linalg.solve(A, [n1 @ c1, n2 @ c2]))
+    return orderCorners(refined)
 
-    # Sort corners to ensure X0Y0 is at the black corner
-    sortedCorners = sorted(corners, key=lambda p: (p[0] + p[1]))  # Sort by sum of coordinates
-    expected = sorted([(0, 0), (0, screenSize[1]), (screenSize[0], 0), screenSize],
-                      key=lambda p: (p[0] + p[1]))  # Sort by sum of coordinates
+def screenGeometryPath(measurement: str) -> str:
+    """
+    Path of the JSON sidecar with the screen location in a measurement
+    """
+    return measurement + ".screen.json"
+
+def readScreenGeometry(measurement: str) -> Optional[List[Tuple[float, float]]]:
+    """
+    Screen corners stored for the measurement or None when there are none or
+    the measurement changed since they were stored
+    """
+    path = screenGeometryPath(measurement)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            geometry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if geometry.get("sha256") != fileDigest(measurement):
+        print(f"Ignoring {path}, the measurement changed")
+        return None
+    return [tuple(c) for c in geometry["corners"]]
 
-    perspTransform = cv.getPerspectiveTransform(np.float32(sortedCorners), np.float32(expected))
-    return cv.warpPerspective(npImg, perspTransform, screenSize)
+def writeScreenGeometry(measurement: str, corners, method: str) -> None:
+    """
+    Store the screen corners and the homography mapping the measurement onto
+    the unit square of the screen, keyed by the hash of the measurement
+    """
+    from .compensation import screenTransform
+    with open(screenGeometryPath(measurement), "w") as f:
+        json.dump({
+            "sha256": fileDigest(measurement),
+            "method": method,
+            "corners": [[float(x), float(y)] for x, y in corners],
+            "homography": screenTransform(corners, (1, 1)).tolist()
+        }, f, indent=4)
+
+def originDistance(point):
+    return point[0] ** 2 + point[1] ** 2
+
+def cropToScreen(image, corners, screenSize):
+    from .compensation import warpPlan
+    npImg = np.asarray(image)
+    return warpPlan(corners, npImg.shape, screenSize).warp(npImg)
 
 @click.command()
 @click.argument("output", type=click.Path())
 @click.option("--measurement", type=click.Path(exists=True, file_okay=True, dir_okay=False),
     required=True,
-    help="The full-screen measurement JSON file")
+    help="The full-screen measurement file (JSON or binary)")
 @click.option("--min", "min_value", type=int, default=0,
     help="The minimal brightness value (0-255)")
 @click.option("--max", "max_value", type=int, default=255,
@@ -201,158 +498,105 @@ def cropToScreen(image, corners, screenSize):
     help="The screen resolution in pixels")
 @click.option("--manual", is_flag=True,
     help="Locate screen manually")
-def compensate(output, measurement, min_value, max_value, screen, manual):
+@click.option("--auto", is_flag=True,
+    help="Locate screen automatically")
+@click.option("--corners", type=Corners(), default=None,
+    help="Screen corners as 'x1,y1;x2,y2;x3,y3;x4,y4' in measurement cells or a JSON file with them, used without refinement")
+@click.option("--threshold", type=float, default=None,
+    help="Value separating the screen from the background for --auto (default: middle of the value range)")
+@click.option("--tile-rows", type=int, default=0,
+    help="Process the mask in bands of this many rows to bound memory (0 = whole mask at once)")
+@click.option("--pipeline", type=click.Choice(["screen", "native"]), default="screen",
+    help="Compute the compensation on screen pixels or on the measurement grid and resample it once")
+@click.option("--profile", "profiles", multiple=True,
+    help="Name of the compensation curve profile; repeat to render several masks at once")
+@click.option("--profile-file", type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="TOML or JSON file with additional named curve profiles")
+@click.option("--smoothing", type=click.Choice(["opencv", "scipy"]), default="opencv",
+    help="Backend of the Gaussian smoothing stage")
+@click.option("--threads", type=int, default=None,
+    help="Number of threads for the scipy smoothing backend (default: number of CPUs)")
+@click.option("--encode", type=click.Choice(["fast", "balanced", "smallest"]), default="smallest",
+    help="Encoder preset trading file size for speed")
+@click.option("--depth", type=click.Choice(["8", "16"]), default="8",
+    help="Bit depth of the mask")
+@click.option("--no-warp-cache", "warp_cache", is_flag=True, flag_value=False, default=True,
+    help="Do not store the warp plan in the cache directory (see DRLCD_WARP_CACHE_MB)")
+@click.option("--timings", is_flag=True,
+    help="Report the time spent in each stage of the pipeline")
+@click.option("--profile-stages", "profile_stages", type=click.Path(dir_okay=False),
+    help="Write wall time, CPU time and peak memory of each stage to this JSON report")
+def compensate(output, measurement, min_value, max_value, screen, manual, auto, corners, threshold, tile_rows, pipeline,
+               profiles, profile_file, smoothing, threads, encode, depth, warp_cache, timings, profile_stages):
     """
     Build a compensation mask for a given LCD. Provide a full-screen measurement
     and screen resolution to build a PNG compensation mask that you can load
     into UVTools and apply it.
+
+    With several profiles, one mask per profile is written; OUTPUT may contain
+    {profile}, otherwise the profile name is appended to the file name. The
+    extension of OUTPUT selects PNG, TIFF (.tif) or headerless raw pixels (.raw).
+
+    Screen corners located with --manual or --auto are refined to sub-pixel
+    precision; corners given by --corners in any order are used exactly as
+    given. They are stored next to the measurement and later runs reuse them
+    until the measurement changes. Otherwise the screen covers the whole
+    measurement.
     """
-    with open(measurement) as f:
-        measurement = json.load(f)
-    
-    # Extract values from the measurement data structure
-    data = np.array([[point['value'] for point in row] for row in measurement["measurements"]])
+    from .compensation import GaussianSmoothing, compensateMeasurement
+    from .profiles import resolveProfiles
+    from .profiling import StageTimer
 
-    # Analyze measurement values
-    min_val = np.nanmin(data)
-    max_val = np.nanmax(data)
-    mean_val = np.nanmean(data)
-    
-    # Calculate a more meaningful minimum value
-    # Use the 5th percentile as minimum to exclude extreme outliers
-    valid_min = np.nanpercentile(data, 5)
-    
-    print(f"\nMeasurement analysis:")
-    print(f"Raw minimum value: {min_val:.2f} mW")
-    print(f"Valid minimum value (5th percentile): {valid_min:.2f} mW")
-    print(f"Maximum value: {max_val:.2f} mW")
-    print(f"Mean value: {mean_val:.2f} mW")
-    print(f"Dynamic range: {max_val/valid_min:.1f}x")
-
-    corners = []
-    if not manual:
-        corners = [(0, 0), (0, data.shape[0]), (data.shape[1], 0), (data.shape[1], data.shape[0])]
-    if len(corners) != 4 or manual:
-        from .manual_crop import locateScreenManually
-        corners = locateScreenManually(data)
-        print(corners)
-
-    map = cropToScreen(data, corners, screen)
-    
-    # Replace any NaN values with the mean value
-    map = np.nan_to_num(map, nan=mean_val)
-    
-    # Apply general smoothing to reduce noise
-    map = gaussian_filter(map, sigma=0.8)
-    
-    # Create base compensation mask
-    compensation = np.ones_like(map)
-    
-    # Define threshold levels based on measured values
-    # Calculate thresholds relative to the measured range
-    max_measured = max_val
-    min_measured = valid_min
-    range_measured = max_measured - min_measured
-    
-    # Create interpolation points for smooth transitions
-    x_points = np.array([min_measured, 
-                        min_measured + range_measured * 0.1,
-                        min_measured + range_measured * 0.2,
-                        min_measured + range_measured * 0.35,
-                        min_measured + range_measured * 0.5,
-                        min_measured + range_measured * 0.65,
-                        min_measured + range_measured * 0.8,
-                        min_measured + range_measured * 0.9,
-                        max_measured])
-    
-    # Sanftere Kompensation mit mehr Zwischenstufen
-    y_points = np.array([0.99, 0.97, 0.95, 0.93, 0.91, 0.89, 0.87, 0.86, 0.85])
-    
-    # Create Akima interpolator for smooth transitions
-    interpolator = Akima1DInterpolator(x_points, y_points)
-    
-    # Apply compensation using interpolation
-    compensation = interpolator(map)
-    compensation = np.clip(compensation, 0.85, 1.0)  # Ensure values stay within reasonable range
-    
-    # Apply edge-preserving smoothing with reduced parameters
-    compensation = cv.bilateralFilter(compensation.astype(np.float32), d=3, sigmaColor=0.02, sigmaSpace=3)
-    
-    # Additional detail-preserving smoothing with minimal smoothing
-    compensation = gaussian_filter(compensation, sigma=0.08)
-    
-    # Handle edge regions - create a border mask
-    border_width = 50  # Width of border region to check
-    height, width = compensation.shape
-    border_mask = np.ones_like(compensation, dtype=bool)
-    border_mask[border_width:-border_width, border_width:-border_width] = False
-    
-    # Set border regions to maximum brightness (1.0) if they are too dark
-    border_values = compensation[border_mask]
-    border_threshold = 0.9  # Sehr hoher Schwellenwert für Randbereiche
-    compensation[border_mask] = np.where(border_values < border_threshold, 1.0, border_values)
-    
-    # Replace any remaining NaN or infinite values with 1.0 (full brightness)
-    compensation = np.nan_to_num(compensation, nan=1.0, posinf=1.0, neginf=1.0)
-    
-    # Ensure all values are within valid range before scaling
-    compensation = np.clip(compensation, 0.0, 1.0)
-    
-    # Scale to output range (0-255)
-    compensation = min_value + (max_value - min_value) * compensation
-    
-    # Calculate statistics for the entire mask
-    valid_values = compensation[compensation > 0]
-    
-    if len(valid_values) > 0:
-        min_valid = np.min(valid_values)
-        max_valid = np.max(valid_values)
-        mean_valid = np.mean(valid_values)
-        
-        print("\nCompensation mask statistics:")
-        print(f"Minimum value: {min_valid:.2f} (0-255)")
-        print(f"Maximum value: {max_valid:.2f} (0-255)")
-        print(f"Mean value (average brightness): {mean_valid:.2f} (0-255)")
-        print(f"Compensation range: {max_valid/min_valid:.1f}x")
-        
-        # Calculate detailed statistics for each threshold
-        print("\nDetailed compensation analysis:")
-        for x, y in zip(x_points, y_points):
-            mask = map > x
-            pixels = np.sum(mask)
-            if pixels > 0:
-                avg_power = np.mean(map[mask])
-                avg_comp = np.mean(compensation[mask])
-                print(f"- Areas >{x:3.1f} mW ({pixels/compensation.size*100:4.1f}% of pixels):")
-                print(f"  Avg power: {avg_power:.2f} mW, Avg compensation: {avg_comp:.1f}")
-        
-        # Calculate and display the impact of compensation
-        strongest_dimming = (min_valid / 255.0) * 100
-        print(f"\nCompensation impact:")
-        print(f"- Maximum brightness reduction: {100-strongest_dimming:.1f}%")
-        print(f"- Compensation thresholds: {min(x_points):.1f} mW to {max(x_points):.1f} mW")
-        print(f"- Compensation range: {min(y_points)*100:.0f}% to 100% of original brightness")
-    else:
-        print("\nWarning: No valid compensation values found (all values are zero)")
-    
-    # Final cleanup and conversion to 8-bit format
-    compensation = np.clip(compensation, 0, 255)  # Ensure values are in valid range
-    compensation = np.round(compensation)  # Round to nearest integer
-    compensation = compensation.astype(np.uint8)  # Convert to 8-bit format
-    
-    # Rotate the image 180 degrees and flip horizontally
-    compensation = cv.rotate(compensation, cv.ROTATE_180)
-    compensation = cv.flip(compensation, 1)  # Flip horizontally
-    
-    # Save with optimized PNG compression and settings
-    cv.imwrite(output, compensation, [
-        cv.IMWRITE_PNG_COMPRESSION, 9,
-        cv.IMWRITE_PNG_STRATEGY, cv.IMWRITE_PNG_STRATEGY_FILTERED,
-        cv.IMWRITE_PNG_BILEVEL, 0
-    ])
-    
-    # Print file size information
-    file_size = os.path.getsize(output)
-    print(f"\nOutput file size: {file_size / 1024:.1f} KB")
+    if manual + auto + (corners is not None) > 1:
+        raise click.UsageError("Use only one of --manual, --auto and --corners")
+    try:
+        curveProfiles = resolveProfiles(list(profiles), profile_file)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--profile")
 
+    timer = StageTimer(memory=profile_stages is not None)
+    with timer.stage("load"):
+        data = loadMeasurement(measurement).values
+
+    if manual or auto or corners is not None:
+        method = "manual" if manual else "automatic" if auto else "specified"
+        with timer.stage("locate"):
+            if corners is not None:
+                corners = orderCorners(corners)
+            elif manual:
+                from .manual_crop import locateScreenManually
+                corners = refineCorners(data, locateScreenManually(data))
+            else:
+                if threshold is None:
+                    threshold = (np.nanmin(data) + np.nanmax(data)) / 2
+                corners = locateScreenAutomatic(data, threshold)
+                if corners is None:
+                    raise click.ClickException("Cannot locate the screen automatically, use --manual")
+        writeScreenGeometry(measurement, corners, method)
+        print(f"Screen corners {[(round(x, 2), round(y, 2)) for x, y in corners]} "
+              f"stored in {screenGeometryPath(measurement)}")
+    else:
+        corners = readScreenGeometry(measurement)
+        if corners is not None:
+            print(f"Using the screen corners from {screenGeometryPath(measurement)}")
 
+    compensateMeasurement(data, measurement, output, screen, min_value, max_value, corners,
+                          pipeline, tile_rows, curveProfiles, GaussianSmoothing(smoothing, threads),
+                          timer, preset=encode, depth=int(depth), warpCache=warp_cache)
+    if timings:
+        timer.print()
+    if profile_stages:
+        timer.writeReport(profile_stages, "compensate", {
+            "measurement": measurement,
+            "output": output,
+            "screen": list(screen),
+            "min": min_value,
+            "max": max_value,
+            "pipeline": pipeline,
+            "tile_rows": tile_rows,
+            "profiles": [p.name for p in curveProfiles],
+            "smoothing": smoothing,
+            "threads": threads,
+            "encode": encode,
+            "depth": int(depth)
+        })
@@ -0,0 +1,384 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+import click
+import numpy as np
+
+BINARY_MAGIC = b"DRLCDM\x00\x01"
+BINARY_ALIGNMENT = 64
+BINARY_DTYPE = np.float32
+
+class Measurement:
+    """
+    A display measurement: value, x and y planes of shape (rows, columns) plus
+    the metadata of the scan (sensor, size, resolution, ...).
+
+    The x and y planes hold the sensor position of each sample in mm. Missing
+    samples are NaN.
+    """
+    def __init__(self, values: np.ndarray, x: np.ndarray, y: np.ndarray,
+                 metadata: Dict[str, Any]) -> None:
+        assert values.shape == x.shape == y.shape
+        self.values = values
+        self.x = x
+        self.y = y
+        self.metadata = metadata
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    @property
+    def resolution(self) -> Tuple[int, int]:
+        return tuple(self.metadata.get("resolution", (self.shape[1], self.shape[0])))
+
+    @property
+    def size(self) -> Optional[Tuple[float, float]]:
+        size = self.metadata.get("size")
+        return tuple(size) if size is not None else None
+
+    @property
+    def sensor(self) -> Optional[str]:
+        return self.metadata.get("sensor")
+
+def gridCoordinates(size: Tuple[float, float], resolution: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return x and y planes (in mm) of a uniform grid spanning size.
+    """
+    xs = np.linspace(0, size[0], resolution[0]) if resolution[0] > 1 else np.zeros(1)
+    ys = np.linspace(0, size[1], resolution[1]) if resolution[1] > 1 else np.zeros(1)
+    return np.meshgrid(xs, ys)
+
+def _parsePoint(point: Any) -> Tuple[float, float, float]:
+    if isinstance(point, dict):
+        return (point.get("value", np.nan), point.get("x", np.nan), point.get("y", np.nan))
+    if point is None:
+        return (np.nan, np.nan, np.nan)
+    return (point, np.nan, np.nan)
+
+def measurementFromJson(data: Dict[str, Any]) -> Measurement:
+    """
+    Build a measurement from the parsed JSON structure. Both the dictionary
+    points ({'value', 'x', 'y'}) and the plain float points are supported.
+    Scattered measurements (a flat "points" list) are regridded to the regular
+    grid given by their size and resolution.
+    """
+    if "points" in data:
+        return _measurementFromScattered(data)
+    rows = data["measurements"]
+    planes = np.array([[_parsePoint(p) for p in row] for row in rows], dtype=float)
+    if planes.ndim != 3:
+        raise ValueError("Measurement rows have different lengths")
+    values, x, y = planes[:, :, 0], planes[:, :, 1], planes[:, :, 2]
+
+    metadata = {k: v for k, v in data.items() if k != "measurements"}
+    metadata.setdefault("resolution", [values.shape[1], values.shape[0]])
+    if "size" in metadata:
+        gridX, gridY = gridCoordinates(metadata["size"], metadata["resolution"])
+        x = np.where(np.isnan(x), gridX, x)
+        y = np.where(np.isnan(y), gridY, y)
+    return Measurement(values, x, y, metadata)
+
+def _measurementFromScattered(data: Dict[str, Any]) -> Measurement:
+    from .sampling import regridScattered
+
+    points = [_parsePoint(p) for p in data["points"]]
+    values, x, y = np.array(points, dtype=float).reshape(-1, 3).T
+    metadata = {k: v for k, v in data.items() if k != "points"}
+    metadata["layout"] = "regridded"
+    metadata["scattered_points"] = len(points)
+    values, x, y = regridScattered(x, y, values, metadata["size"], metadata["resolution"])
+    return Measurement(values, x, y, metadata)
+
+def measurementToJson(measurement: Measurement) -> Dict[str, Any]:
+    """
+    Convert a measurement into the standard JSON structure.
+    """
+    def point(value, x, y):
+        if np.isnan(value):
+            return {}
+        return {"value": float(value), "x": float(x), "y": float(y)}
+
+    result = dict(measurement.metadata)
+    result["measurements"] = [
+        [point(v, x, y) for v, x, y in zip(vRow, xRow, yRow)]
+        for vRow, xRow, yRow in zip(measurement.values, measurement.x, measurement.y)
+    ]
+    return result
+
+def readJsonMeasurement(path: str) -> Measurement:
+    with open(path) as f:
+        return measurementFromJson(json.load(f))
+
+def writeJsonMeasurement(path: str, measurement: Measurement) -> None:
+    with open(path, "w") as f:
+        json.dump(measurementToJson(measurement), f)
+
+def _binaryLayout(header: bytes) -> int:
+    """
+    Return the offset of the data block for a given header
+    """
+    offset = len(BINARY_MAGIC) + 4 + len(header)
+    return -(-offset // BINARY_ALIGNMENT) * BINARY_ALIGNMENT
+
+def writeBinaryMeasurement(path: str, measurement: Measurement, dtype=BINARY_DTYPE) -> None:
+    """
+    Write the measurement in the columnar binary format: magic, little-endian
+    uint32 header length, JSON header and the aligned planes (value, x, y) in
+    C order. The planes are float32 unless dtype says otherwise.
+    """
+    rows, cols = measurement.shape
+    header = json.dumps({
+        "metadata": measurement.metadata,
+        "dtype": np.dtype(dtype).str,
+        "shape": [3, rows, cols]
+    }).encode("utf-8")
+    offset = _binaryLayout(header)
+    planes = np.stack([measurement.values, measurement.x, measurement.y]).astype(dtype)
+    with open(path, "wb") as f:
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(b"\x00" * (offset - f.tell()))
+        f.write(np.ascontiguousarray(planes).tobytes())
+
+def readBinaryMeasurement(path: str) -> Measurement:
+    """
+    Open a binary measurement. The planes are read-only memory maps of the
+    file, nothing is copied.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a DrLCD binary measurement")
+        headerLength, = struct.unpack("<I", f.read(4))
+        header = f.read(headerLength)
+    spec = json.loads(header.decode("utf-8"))
+    planes = np.memmap(path, dtype=np.dtype(spec["dtype"]), mode="r",
+                       offset=_binaryLayout(header), shape=tuple(spec["shape"]))
+    return Measurement(planes[0], planes[1], planes[2], spec["metadata"])
+
+def isBinaryMeasurement(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def fileDigest(path: str) -> str:
+    """
+    SHA-256 of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cacheDirectory() -> str:
+    """
+    Directory of the parsed measurement cache. Can be overridden via the
+    DRLCD_CACHE_DIR environment variable.
+    """
+    if "DRLCD_CACHE_DIR" in os.environ:
+        return os.environ["DRLCD_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "drlcd")
+
+def cachePath(path: str) -> str:
+    """
+    Return the cache file for a given measurement file. The name is the hash
+    of the absolute path followed by the hash of the modification time and
+    size, so any change of the source file invalidates the entry.
+    """
+    stat = os.stat(path)
+    source = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    version = hashlib.sha1(f"{stat.st_mtime_ns}\0{stat.st_size}".encode("utf-8")).hexdigest()
+    return os.path.join(cacheDirectory(), f"{source}-{version}.drlcd")
+
+def _removeStaleEntries(target: str) -> None:
+    """
+    Remove the cache entries of older versions of the target's source file
+    """
+    directory, name = os.path.split(target)
+    source = name.split("-")[0]
+    for entry in os.listdir(directory):
+        if entry != name and entry.startswith(source + "-") and entry.endswith(".drlcd"):
+            try:
+                os.remove(os.path.join(directory, entry))
+            except FileNotFoundError:
+                pass
+
+def _storeInCache(target: str, measurement: Measurement) -> None:
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        os.close(fd)
+        try:
+            # Keep full precision, cached and fresh loads have to be identical
+            writeBinaryMeasurement(tmpPath, measurement, dtype=np.float64)
+            os.replace(tmpPath, target)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        _removeStaleEntries(target)
+    except OSError as e:
+        # The cache is only an optimization, never fail the load because of it
+        print(f"Warning: cannot cache measurement: {e}")
+
+def loadMeasurement(path: str, cache: bool = True) -> Measurement:
+    """
+    Load a measurement file; the reader is chosen based on the file content,
+    so the binary format is recognized regardless of its suffix.
+
+    Parsed JSON measurements are kept in an on-disk cache in the binary format;
+    repeated loads of an unchanged file skip the JSON parsing and only map the
+    cached planes.
+    """
+    if isBinaryMeasurement(path):
+        return readBinaryMeasurement(path)
+    if not cache:
+        return readJsonMeasurement(path)
+
+    cached = cachePath(path)
+    if os.path.exists(cached):
+        try:
+            return readBinaryMeasurement(cached)
+        except (OSError, ValueError):
+            pass
+    measurement = readJsonMeasurement(path)
+    _storeInCache(cached, measurement)
+    return measurement
+
+def saveMeasurement(path: str, measurement: Measurement) -> None:
+    """
+    Save a measurement; the writer is chosen based on the file suffix.
+    """
+    if os.path.splitext(path)[1].lower() == ".json":
+        writeJsonMeasurement(path, measurement)
+    else:
+        writeBinaryMeasurement(path, measurement)
+
+def partialPath(path: str) -> str:
+    """
+    Return the path of the row log kept while the measurement is acquired.
+    """
+    return path + ".partial.jsonl"
+
+def readPartialMeasurement(path: str) -> Tuple[Dict[str, Any], Dict[int, List[Any]], int]:
+    """
+    Read a row log. Return the metadata, the completed rows keyed by the row
+    index and the byte length of the valid part of the log. A trailing line cut
+    by a crash is ignored.
+    """
+    rows = {}
+    validLength = 0
+    with open(path, "rb") as f:
+        header = f.readline()
+        if not header.endswith(b"\n"):
+            raise ValueError(f"{path} has no complete header")
+        metadata = json.loads(header.decode("utf-8"))
+        validLength = len(header)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                break
+            rows[record["row"]] = record["points"]
+            validLength += len(line)
+    return metadata, rows, validLength
+
+class MeasurementWriter:
+    """
+    Append-only writer of a measurement in progress. The first line of the log
+    is the JSON metadata, each following line is one completed row. Every row
+    is flushed to disk immediately, so a crash loses at most the row being
+    measured. Call finalize() to produce the standard measurement file.
+
+    A new writer refuses to overwrite an existing log (FileExistsError); use
+    resume() to continue it.
+    """
+    def __init__(self, path: str, metadata: Dict[str, Any]) -> None:
+        self.path = path
+        self.metadata = metadata
+        self.rows: Dict[int, List[Any]] = {}
+        self._file = open(path, "xb")
+        self._writeLine(metadata)
+
+    @classmethod
+    def resume(cls, path: str) -> "MeasurementWriter":
+        """
+        Reopen an existing row log for appending. The rows already captured
+        are available in `rows`.
+        """
+        metadata, rows, validLength = readPartialMeasurement(path)
+        writer = cls.__new__(cls)
+        writer.path = path
+        writer.metadata = metadata
+        writer.rows = rows
+        writer._file = open(path, "r+b")
+        # Drop a row cut by a crash before appending new ones
+        writer._file.truncate(validLength)
+        writer._file.seek(validLength)
+        return writer
+
+    def __enter__(self) -> "MeasurementWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def completedRows(self) -> List[int]:
+        return sorted(self.rows.keys())
+
+    def _writeLine(self, record: Any) -> None:
+        self._file.write((json.dumps(record) + "\n").encode("utf-8"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def writeRow(self, index: int, points: List[Any]) -> None:
+        self.rows[index] = points
+        self._writeLine({"row": index, "points": points})
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def finalize(self, output: str, removeLog: bool = True) -> Dict[str, Any]:
+        """
+        Write the standard measurement file. Rows that were not measured are
+        filled with empty points; scattered measurements store all points in
+        a flat list. Returns the written structure.
+        """
+        self.close()
+        resolution = self.metadata["resolution"]
+        result = dict(self.metadata)
+        if self.metadata.get("layout") == "scattered":
+            # Rows of a scattered measurement are the passes of the planner
+            result["points"] = [p for index in sorted(self.rows) for p in self.rows[index]]
+        else:
+            result["measurements"] = [
+                self.rows.get(y, [{} for _ in range(resolution[0])])
+                for y in range(resolution[1])
+            ]
+        with open(output, "w") as f:
+            json.dump(result, f)
+        if removeLog:
+            os.remove(self.path)
+        return result
+
+@click.command()
+@click.argument("input", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("output", type=click.Path())
+def convert(input, output):
+    """
+    Convert a measurement between the JSON and the binary format. The output
+    format is given by the suffix of OUTPUT: ".json" writes JSON, anything else
+    (preferably ".drlcd") writes the memory-mappable binary format.
+    """
+    measurement = loadMeasurement(input)
+    saveMeasurement(output, measurement)
+    print(f"Converted {input} ({measurement.shape[1]}x{measurement.shape[0]}) to {output}")
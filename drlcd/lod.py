@@ -0,0 +1,140 @@
+import json
+import math
+import os
+from typing import Any, Dict, Tuple
+import numpy as np
+
+# Full resolution tiles have this many cells per side
+TILE_SIZE = 256
+POOLING_METHODS = ["mean", "max"]
+
+def lodFactor(shape: Tuple[int, int], maxCells: int) -> int:
+    """
+    Smallest block size that pools a grid of the shape to at most maxCells
+    cells
+    """
+    height, width = shape
+    factor = max(1, math.ceil(math.sqrt(height * width / maxCells)))
+    while math.ceil(height / factor) * math.ceil(width / factor) > maxCells:
+        factor += 1
+    return factor
+
+def poolGrid(values: np.ndarray, factor: int, method: str = "mean") -> np.ndarray:
+    """
+    Pool factor×factor blocks of the grid by their mean or maximum ignoring
+    NaN cells; blocks at the right and bottom border may be partial. Blocks
+    without a valid cell are NaN.
+    """
+    if method not in POOLING_METHODS:
+        raise ValueError(f"Unknown pooling method {method}, use one of {', '.join(POOLING_METHODS)}")
+    height, width = values.shape
+    padded = np.pad(np.asarray(values, dtype=np.float32), ((0, -height % factor), (0, -width % factor)),
+                    constant_values=np.nan)
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    if method == "max":
+        pooled = np.where(valid, blocks, -np.inf).max(axis=(1, 3))
+    else:
+        pooled = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64) / np.maximum(count, 1)
+    return np.where(count > 0, pooled, np.nan).astype(np.float32)
+
+def blockCenters(length: int, factor: int) -> np.ndarray:
+    """
+    Coordinates of the pooled blocks along an axis in full resolution cells
+    """
+    starts = np.arange(0, length, factor)
+    return (starts + (np.minimum(starts + factor, length) - 1)) / 2
+
+def writeTiles(values: np.ndarray, directory: str, tileSize: int = TILE_SIZE) -> None:
+    """
+    Store the grid as headerless little-endian float32 tiles named
+    <tile row>_<tile column>.f32; border tiles are smaller.
+    """
+    os.makedirs(directory, exist_ok=True)
+    height, width = values.shape
+    for ty in range(0, math.ceil(height / tileSize)):
+        for tx in range(0, math.ceil(width / tileSize)):
+            tile = values[ty * tileSize:(ty + 1) * tileSize, tx * tileSize:(tx + 1) * tileSize]
+            np.ascontiguousarray(tile, dtype="<f4").tofile(os.path.join(directory, f"{ty}_{tx}.f32"))
+
+TILE_LOADER = """
+(function() {
+    var gd = document.getElementById('{plot_id}');
+    var lod = %s;
+    var tiles = {}, coarse = null, request = 0;
+
+    function loadTile(tx, ty) {
+        var key = ty + '_' + tx;
+        if (!tiles[key]) {
+            tiles[key] = fetch(lod.url + '/' + key + '.f32').then(function(response) {
+                if (!response.ok)
+                    throw new Error(response.statusText);
+                return response.arrayBuffer();
+            }).then(function(buffer) { return new Float32Array(buffer); });
+        }
+        return tiles[key];
+    }
+
+    function span(range, length) {
+        var lo = Math.min(range[0], range[1]), hi = Math.max(range[0], range[1]);
+        return [Math.max(0, Math.floor(lo)), Math.min(length, Math.ceil(hi) + 1)];
+    }
+
+    gd.on('plotly_relayout', function() {
+        var trace = gd.data[lod.trace];
+        if (!coarse)
+            coarse = {x: [trace.x], y: [trace.y], z: [trace.z]};
+        var xs = span(gd._fullLayout.xaxis.range, lod.width);
+        var ys = span(gd._fullLayout.yaxis.range, lod.height);
+        var id = ++request;
+        if ((xs[1] - xs[0]) * (ys[1] - ys[0]) > lod.maxCells) {
+            Plotly.restyle(gd, coarse, [lod.trace]);
+            return;
+        }
+        var wanted = [];
+        for (var ty = Math.floor(ys[0] / lod.tile); ty * lod.tile < ys[1]; ty++)
+            for (var tx = Math.floor(xs[0] / lod.tile); tx * lod.tile < xs[1]; tx++)
+                wanted.push([tx, ty]);
+        Promise.all(wanted.map(function(t) { return loadTile(t[0], t[1]); })).then(function(buffers) {
+            if (id !== request)
+                return;
+            var z = [], x = [], y = [];
+            for (var i = xs[0]; i < xs[1]; i++)
+                x.push(i);
+            for (var j = ys[0]; j < ys[1]; j++) {
+                y.push(j);
+                z.push(new Float32Array(xs[1] - xs[0]));
+            }
+            wanted.forEach(function(t, k) {
+                var left = t[0] * lod.tile, top = t[1] * lod.tile;
+                var tileWidth = Math.min(lod.tile, lod.width - left);
+                var from = Math.max(xs[0], left), to = Math.min(xs[1], left + tileWidth);
+                for (var row = Math.max(ys[0], top); row < Math.min(ys[1], top + lod.tile); row++) {
+                    var offset = (row - top) * tileWidth - left;
+                    z[row - ys[0]].set(buffers[k].subarray(offset + from, offset + to), from - xs[0]);
+                }
+            });
+            Plotly.restyle(gd, {x: [x], y: [y], z: [z]}, [lod.trace]);
+        }).catch(function(error) {
+            console.warn('Cannot load full resolution tiles from ' + lod.url + ': ' + error);
+        });
+    });
+})();
+"""
+
+def tileLoaderScript(shape: Tuple[int, int], url: str, maxCells: int, trace: int,
+                     tileSize: int = TILE_SIZE) -> str:
+    """
+    Plotly post script replacing the heatmap trace with full resolution tiles
+    fetched from url once the zoomed view has at most maxCells cells
+    """
+    index: Dict[str, Any] = {
+        "width": shape[1],
+        "height": shape[0],
+        "tile": tileSize,
+        "url": url,
+        "maxCells": maxCells,
+        "trace": trace
+    }
+    return TILE_LOADER % json.dumps(index)
@@ -1,5 +1,6 @@
+import time
 from contextlib import contextmanager
-from typing import Generator, List
+from typing import Generator, List, Tuple
 from serial import Serial # type: ignore
 from pyaxidraw import axidraw   # import module
 
@@ -34,3 +35,21 @@ class Machine:
     def stop_measure(self) -> None:
         self.axidraw.penup()
         self.axidraw.block()
+
+    def set_sweep_speed(self, speed: float) -> None:
+        """
+        Set the speed of pen-down moves in percent of the maximum speed
+        """
+        self.axidraw.options.speed_pendown = speed
+        self.axidraw.update()
+
+    def sweep_to(self, x: float, y: float) -> Tuple[float, float]:
+        """
+        Move to the target with the pen down without stopping on the way.
+        Return the monotonic time when the move was issued and when it
+        finished.
+        """
+        start = time.monotonic()
+        self.axidraw.lineto(x, y)
+        self.axidraw.block()
+        return start, time.monotonic()
@@ -10,6 +10,9 @@ LINE_WIDTH = 3
 CORNER_COLOR = (255, 0, 0)
 CORNER_RADIUS = 10
 
+# Upper bound of redraws per second while dragging
+FRAME_RATE = 30
+
 class ManualScreenLocator:
     """
     The user can select image corners via simple GUI
@@ -24,6 +27,7 @@ class ManualScreenLocator:
         self._img = self._prepareImg(self._srcImg)
         self._corners = self._prepareCorners(self._windowSize)
         self._activeCornerIdx = None
+        self._dirty = []
 
         self._window = pygame.display.set_mode(self._windowSize)
 
@@ -50,25 +54,54 @@ class ManualScreenLocator:
         ]
 
     def run(self):
+        """
+        Block until events arrive and redraw only the areas changed by them, at
+        most FRAME_RATE times per second
+        """
+        clock = pygame.time.Clock()
+        self._redraw()
+        pygame.display.flip()
         running = True
         while running:
-            for event in pygame.event.get():
+            for event in [pygame.event.wait()] + pygame.event.get():
                 running = running and self._handleEvent(event)
-            self._redraw()
-            pygame.display.flip()
+            if self._dirty:
+                area = self._dirty[0].unionall(self._dirty[1:])
+                self._dirty = []
+                self._redraw(area)
+                pygame.display.update(area)
+            clock.tick(FRAME_RATE)
         pygame.quit()
 
-    def _redraw(self):
-        self._window.fill((0, 0, 0))
-        self._window.blit(self._img, (0, 0))
+    def _redraw(self, area=None):
+        """
+        Redraw the given window rectangle or the whole window
+        """
+        area = area or self._window.get_rect()
+        self._window.set_clip(area)
+        self._window.fill((0, 0, 0), area)
+        self._window.blit(self._img, area.topleft, area)
 
         pygame.draw.lines(self._window, LINE_COLOR, True, self._corners, LINE_WIDTH)
         for corner in self._corners:
             pygame.draw.circle(self._window, CORNER_COLOR, corner, CORNER_RADIUS, 1)
+        self._window.set_clip(None)
+
+    def _cornerArea(self, idx):
+        """
+        Window rectangle covered by a corner marker and its two edges
+        """
+        points = [self._corners[(idx + k) % len(self._corners)] for k in (-1, 0, 1)]
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        margin = CORNER_RADIUS + LINE_WIDTH
+        left, top = int(min(xs)) - margin, int(min(ys)) - margin
+        return pygame.Rect(left, top, int(max(xs)) + margin + 1 - left, int(max(ys)) + margin + 1 - top)
 
     def _handleEvent(self, event):
         if self._isQuitEvent(event):
             return False
+        if event.type == pygame.VIDEOEXPOSE:
+            self._dirty.append(self._window.get_rect())
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
             self._onDragStart(event.pos)
         if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
@@ -89,7 +122,9 @@ class ManualScreenLocator:
     def _onDrag(self, pos):
         if self._activeCornerIdx is None:
             return
+        self._dirty.append(self._cornerArea(self._activeCornerIdx))
         self._corners[self._activeCornerIdx] = pos
+        self._dirty.append(self._cornerArea(self._activeCornerIdx))
 
     @staticmethod
     def _isQuitEvent(event):
@@ -0,0 +1,205 @@
+from typing import Callable, Dict, Sequence, Tuple
+import click
+import numpy as np
+from .ui_common import Resolution
+
+# Defaults of the travel time model, roughly an AxiDraw moving pen-up
+DEFAULT_SPEED = 100.0  # mm/s
+DEFAULT_ACCELERATION = 500.0  # mm/s^2
+TWO_OPT_LIMIT = 1000  # Larger point sets only get the nearest-neighbor tour
+
+def _asPoints(points: Sequence[Tuple[float, float]]) -> np.ndarray:
+    return np.asarray(points, dtype=float).reshape(-1, 2)
+
+def _rowKeys(points: np.ndarray) -> np.ndarray:
+    """
+    Group points into rows by their y coordinate. Grid points share exact rows;
+    scattered points are grouped into horizontal bands.
+    """
+    rows = np.round(points[:, 1], 6)
+    bandCount = max(1, int(np.round(np.sqrt(len(points)))))
+    if len(np.unique(rows)) <= 2 * bandCount:
+        return rows
+    low, high = rows.min(), rows.max()
+    return np.floor((rows - low) / (high - low) * bandCount).clip(max=bandCount - 1)
+
+def orderRaster(points: Sequence[Tuple[float, float]], start=(0, 0)) -> np.ndarray:
+    """
+    Visit rows from the top, every row left to right
+    """
+    points = _asPoints(points)
+    return np.lexsort((points[:, 0], _rowKeys(points)))
+
+def orderSerpentine(points: Sequence[Tuple[float, float]], start=(0, 0)) -> np.ndarray:
+    """
+    Visit rows from the top, alternating the direction in every row
+    """
+    points = _asPoints(points)
+    rows = _rowKeys(points)
+    _, rowIndex = np.unique(rows, return_inverse=True)
+    direction = np.where(rowIndex % 2 == 0, 1, -1)
+    return np.lexsort((direction * points[:, 0], rows))
+
+def hilbertIndex(ix: np.ndarray, iy: np.ndarray, order: int) -> np.ndarray:
+    """
+    Return the distance of integer points along the Hilbert curve filling the
+    2^order × 2^order square.
+    """
+    ix = np.array(ix, dtype=np.int64)
+    iy = np.array(iy, dtype=np.int64)
+    d = np.zeros_like(ix)
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = (ix & s) > 0
+        ry = (iy & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        ix = np.where(flip, s - 1 - ix, ix)
+        iy = np.where(flip, s - 1 - iy, iy)
+        swap = ~ry
+        ix, iy = np.where(swap, iy, ix), np.where(swap, ix, iy)
+        s >>= 1
+    return d
+
+def orderHilbert(points: Sequence[Tuple[float, float]], start=(0, 0)) -> np.ndarray:
+    """
+    Visit points along a Hilbert curve laid over their bounding box
+    """
+    points = _asPoints(points)
+    if len(points) < 2:
+        return np.arange(len(points))
+    # Map the points onto a square lattice fine enough to separate them
+    order = max(1, int(np.ceil(np.log2(np.sqrt(len(points)) * 4))))
+    side = (1 << order) - 1
+    low = points.min(axis=0)
+    extent = np.max(points.max(axis=0) - low) or 1
+    scaled = np.round((points - low) / extent * side).astype(np.int64)
+    return np.argsort(hilbertIndex(scaled[:, 0], scaled[:, 1], order), kind="stable")
+
+def orderTsp(points: Sequence[Tuple[float, float]], start=(0, 0)) -> np.ndarray:
+    """
+    Approximate the shortest open tour from start: a nearest-neighbor tour
+    improved by 2-opt moves on point sets up to TWO_OPT_LIMIT points.
+    """
+    points = _asPoints(points)
+    n = len(points)
+    if n == 0:
+        return np.arange(0)
+    remaining = np.ones(n, dtype=bool)
+    tour = np.empty(n, dtype=np.int64)
+    current = np.asarray(start, dtype=float)
+    for i in range(n):
+        distances = np.sum((points - current) ** 2, axis=1)
+        distances[~remaining] = np.inf
+        nxt = int(np.argmin(distances))
+        tour[i] = nxt
+        remaining[nxt] = False
+        current = points[nxt]
+    if n <= TWO_OPT_LIMIT:
+        tour = _twoOpt(points, tour, np.asarray(start, dtype=float))
+    return tour
+
+def _twoOpt(points: np.ndarray, tour: np.ndarray, start: np.ndarray) -> np.ndarray:
+    """
+    Reverse tour segments while it shortens the open path from start
+    """
+    improved = True
+    while improved:
+        improved = False
+        path = np.vstack([start, points[tour]])
+        for i in range(1, len(path) - 1):
+            a, b = path[i - 1], path[i]
+            # Reversing path[i:j+1] replaces edges (a, b) and (c, d) with
+            # (a, c) and (b, d); the tour end has no d
+            c = path[i + 1:]
+            d = np.vstack([path[i + 2:], np.full((1, 2), np.nan)])
+            old = np.linalg.norm(b - a) + np.nan_to_num(np.linalg.norm(d - c, axis=1))
+            new = np.linalg.norm(c - a, axis=1) + np.nan_to_num(np.linalg.norm(d - b, axis=1))
+            gain = old - new
+            k = int(np.argmax(gain))
+            if gain[k] > 1e-9:
+                # path[i:j+1] is tour[i-1:j]
+                j = i + 1 + k
+                tour[i - 1:j] = tour[i - 1:j][::-1]
+                path = np.vstack([start, points[tour]])
+                improved = True
+    return tour
+
+STRATEGIES: Dict[str, Callable[..., np.ndarray]] = {
+    "raster": orderRaster,
+    "serpentine": orderSerpentine,
+    "hilbert": orderHilbert,
+    "tsp": orderTsp,
+}
+
+def planPath(points: Sequence[Tuple[float, float]], strategy: str = "serpentine", start=(0, 0)) -> np.ndarray:
+    """
+    Return the visiting order (indices into points) for a given strategy
+    """
+    try:
+        return STRATEGIES[strategy](points, start=start)
+    except KeyError:
+        raise ValueError(f"Unknown path strategy {strategy}") from None
+
+def moveTimes(distances: np.ndarray, speed: float = DEFAULT_SPEED,
+              acceleration: float = DEFAULT_ACCELERATION) -> np.ndarray:
+    """
+    Duration of point-to-point moves with a trapezoidal velocity profile
+    """
+    distances = np.asarray(distances, dtype=float)
+    rampDistance = speed ** 2 / acceleration
+    return np.where(distances >= rampDistance,
+                    distances / speed + speed / acceleration,
+                    2 * np.sqrt(distances / acceleration))
+
+def travelTime(points: Sequence[Tuple[float, float]], order: np.ndarray, start=(0, 0),
+               speed: float = DEFAULT_SPEED, acceleration: float = DEFAULT_ACCELERATION,
+               dwell: float = 0.0) -> float:
+    """
+    Estimate the time to visit the points in given order, including a fixed
+    dwell (settle) time per point.
+    """
+    points = _asPoints(points)
+    path = np.vstack([np.asarray(start, dtype=float), points[order]])
+    distances = np.linalg.norm(np.diff(path, axis=0), axis=1)
+    return float(np.sum(moveTimes(distances, speed, acceleration)) + dwell * len(points))
+
+def pathLength(points: np.ndarray, tour: np.ndarray, start=(0, 0)) -> float:
+    """
+    Length of the open path from start visiting the points in given order
+    """
+    points = _asPoints(points)
+    path = np.vstack([np.asarray(start, dtype=float), points[tour]])
+    return float(np.sum(np.linalg.norm(np.diff(path, axis=0), axis=1)))
+
+def gridPoints(size: Tuple[float, float], resolution: Tuple[int, int]) -> np.ndarray:
+    xs = np.linspace(0, size[0], resolution[0])
+    ys = np.linspace(0, size[1], resolution[1])
+    gridX, gridY = np.meshgrid(xs, ys)
+    return np.stack([gridX.ravel(), gridY.ravel()], axis=1)
+
+@click.command()
+@click.option("--size", type=Resolution(), required=True,
+    help="Screen size in millimeters")
+@click.option("--resolution", type=Resolution(), required=True,
+    help="Number of samples in horizontal and vertical direction")
+@click.option("--speed", type=float, default=DEFAULT_SPEED,
+    help="Travel speed in mm/s")
+@click.option("--acceleration", type=float, default=DEFAULT_ACCELERATION,
+    help="Acceleration in mm/s^2")
+@click.option("--dwell", type=float, default=0.5,
+    help="Time spent measuring each point in seconds")
+@click.option("--strategy", "strategies", type=click.Choice(list(STRATEGIES)), multiple=True,
+    help="Strategies to compare (default: all)")
+def scanpath(size, resolution, speed, acceleration, dwell, strategies):
+    """
+    Estimate the scan time of a grid measurement for each path strategy
+    """
+    points = gridPoints(size, resolution)
+    print(f"{'strategy':>12} {'travel [mm]':>12} {'time [min]':>11}")
+    for strategy in strategies or STRATEGIES:
+        order = planPath(points, strategy)
+        length = pathLength(points, order)
+        duration = travelTime(points, order, speed=speed, acceleration=acceleration, dwell=dwell)
+        print(f"{strategy:>12} {length:>12.0f} {duration / 60:>11.1f}")
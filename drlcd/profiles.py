@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+class CurveProfile(NamedTuple):
+    """
+    A compensation transfer curve. The breakpoints are fractions of the
+    measured range (from the 5th percentile to the maximum) and the
+    compensation for them.
+    """
+    name: str
+    fractions: Tuple[float, ...]
+    values: Tuple[float, ...]
+    kind: str = "akima"
+    clamp: Tuple[float, float] = (0.85, 1.0)
+
+# scipy.interpolate is imported only when a curve is built to keep the CLI
+# startup fast
+def _akima(x: np.ndarray, y: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    from scipy.interpolate import Akima1DInterpolator
+    return Akima1DInterpolator(x, y)
+
+def _pchip(x: np.ndarray, y: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    from scipy.interpolate import PchipInterpolator
+    return PchipInterpolator(x, y, extrapolate=False)
+
+def _cubic(x: np.ndarray, y: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    from scipy.interpolate import CubicSpline
+    return CubicSpline(x, y, extrapolate=False)
+
+def _linear(x: np.ndarray, y: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    return lambda values: np.interp(values, x, y, left=np.nan, right=np.nan)
+
+# Interpolation kinds; all of them yield NaN outside of the breakpoints
+INTERPOLATORS: Dict[str, Callable[[np.ndarray, np.ndarray], Callable[[np.ndarray], np.ndarray]]] = {
+    "akima": _akima,
+    "pchip": _pchip,
+    "cubic": _cubic,
+    "linear": _linear
+}
+
+# Sanftere Kompensation mit mehr Zwischenstufen
+DEFAULT_PROFILE = CurveProfile("default",
+    fractions=(0.0, 0.1, 0.2, 0.35, 0.5, 0.65, 0.8, 0.9, 1.0),
+    values=(0.99, 0.97, 0.95, 0.93, 0.91, 0.89, 0.87, 0.86, 0.85))
+
+BUILTIN_PROFILES = {
+    DEFAULT_PROFILE.name: DEFAULT_PROFILE,
+    "linear": DEFAULT_PROFILE._replace(name="linear", kind="linear")
+}
+
+def profileFromDict(name: str, data: Dict[str, Any]) -> CurveProfile:
+    fractions = tuple(float(x) for x in data["fractions"])
+    values = tuple(float(x) for x in data["values"])
+    kind = data.get("kind", DEFAULT_PROFILE.kind)
+    clamp = tuple(float(x) for x in data.get("clamp", DEFAULT_PROFILE.clamp))
+    if len(fractions) != len(values) or len(fractions) < 2:
+        raise ValueError(f"Profile {name} needs the same number (at least 2) of fractions and values")
+    if any(b <= a for a, b in zip(fractions, fractions[1:])):
+        raise ValueError(f"Profile {name} has fractions that are not increasing")
+    if fractions[0] != 0 or fractions[-1] != 1:
+        # Outside of the breakpoints the curve is undefined
+        raise ValueError(f"Profile {name} has fractions that do not span the range from 0 to 1")
+    if kind not in INTERPOLATORS:
+        raise ValueError(f"Profile {name} has unknown interpolation {kind}")
+    if len(clamp) != 2 or clamp[0] > clamp[1]:
+        raise ValueError(f"Profile {name} has an invalid clamp range")
+    return CurveProfile(name, fractions, values, kind, clamp)
+
+def profileToDict(profile: CurveProfile) -> Dict[str, Any]:
+    return {
+        "fractions": list(profile.fractions),
+        "values": list(profile.values),
+        "kind": profile.kind,
+        "clamp": list(profile.clamp)
+    }
+
+def _readToml(path: str) -> Dict[str, Any]:
+    try:
+        import tomllib
+    except ImportError:  # Python < 3.11
+        import tomli as tomllib
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+def readConfigFile(path: str) -> Dict[str, Any]:
+    """
+    Read a TOML (by suffix) or JSON file
+    """
+    if os.path.splitext(path)[1].lower() == ".toml":
+        return _readToml(path)
+    with open(path) as f:
+        return json.load(f)
+
+def readProfiles(path: str) -> Dict[str, CurveProfile]:
+    """
+    Read named profiles from a TOML or JSON file. Every top-level table is a
+    profile with increasing fractions from 0 to 1, e.g.:
+
+        [strong]
+        fractions = [0.0, 0.5, 1.0]
+        values = [0.99, 0.9, 0.75]
+        kind = "pchip"
+        clamp = [0.75, 1.0]
+    """
+    data = readConfigFile(path)
+    return {name: profileFromDict(name, definition) for name, definition in data.items()}
+
+def resolveProfiles(names: List[str], path: Optional[str] = None) -> List[CurveProfile]:
+    """
+    Look up profiles by name in the profile file (if any) and among the
+    built-in ones.
+    """
+    available = dict(BUILTIN_PROFILES)
+    if path is not None:
+        available.update(readProfiles(path))
+    if not names:
+        names = [DEFAULT_PROFILE.name]
+    missing = [n for n in names if n not in available]
+    if missing:
+        raise ValueError(f"Unknown profiles {', '.join(missing)}; available: {', '.join(available)}")
+    return [available[n] for n in names]
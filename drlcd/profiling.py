@@ -0,0 +1,119 @@
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+def peakRss() -> Optional[float]:
+    """
+    Peak resident set size of the process so far in MB; None where the
+    platform does not provide it
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class StageRecord:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        # How much the stage raised the peak RSS of the process, and that
+        # process-wide peak when the stage last ended
+        self.rssGrowth: Optional[float] = None
+        self.processPeakRss: Optional[float] = None
+        self.peakTraced: Optional[float] = None
+
+    def toDict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "wall_s": self.wall,
+            "cpu_s": self.cpu,
+            "peak_rss_growth_mb": self.rssGrowth,
+            "process_peak_rss_mb": self.processPeakRss,
+            "peak_traced_mb": self.peakTraced
+        }
+
+class StageTimer:
+    """
+    Accumulates the time spent in named pipeline stages. With memory, it also
+    records how much each stage raised the peak RSS of the process (zero when
+    it stayed below an earlier peak) and the peak of memory allocated through
+    Python (including numpy) within the stage using tracemalloc, which slows
+    the pipeline down. The traced peak needs tracemalloc.reset_peak (Python
+    3.9+) and is left out without it.
+    """
+    def __init__(self, memory: bool = False) -> None:
+        self.stages: Dict[str, StageRecord] = {}
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        record = self.stages.setdefault(name, StageRecord())
+        traced = self.memory and hasattr(tracemalloc, "reset_peak")  # Python 3.9+
+        if self.memory:
+            startRss = peakRss()
+        if traced:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start, startCpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record.calls += 1
+            record.wall += time.perf_counter() - start
+            record.cpu += time.process_time() - startCpu
+            if traced:
+                peak = (tracemalloc.get_traced_memory()[1] - baseline) / (1024 * 1024)
+                record.peakTraced = max(record.peakTraced or 0.0, peak)
+            if self.memory:
+                record.processPeakRss = peakRss()
+                if record.processPeakRss is not None:
+                    record.rssGrowth = max(record.rssGrowth or 0.0, record.processPeakRss - startRss)
+
+    @property
+    def total(self) -> float:
+        return sum(r.wall for r in self.stages.values())
+
+    def print(self) -> None:
+        total = self.total
+        print("\nTime per stage:")
+        for name, record in self.stages.items():
+            line = (f"- {name:<12} {record.wall * 1000:>9.1f} ms ({record.wall / max(total, 1e-12) * 100:4.1f}%), "
+                    f"CPU {record.cpu * 1000:>9.1f} ms")
+            if record.peakTraced is not None:
+                line += f", peak allocated {record.peakTraced:>8.1f} MB"
+            if record.rssGrowth is not None:
+                line += f", peak RSS +{record.rssGrowth:>7.1f} MB (process {record.processPeakRss:.1f} MB)"
+            print(line)
+
+    def report(self, command: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        import numpy as np
+        import cv2 as cv
+        return {
+            "command": command,
+            "arguments": arguments,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv.__version__,
+            "cpus": os.cpu_count(),
+            "memory_tracing": self.memory,
+            "total_s": self.total,
+            "peak_rss_mb": peakRss(),
+            "stages": {name: record.toDict() for name, record in self.stages.items()}
+        }
+
+    def writeReport(self, path: str, command: str, arguments: Dict[str, Any]) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(command, arguments), f, indent=4)
@@ -0,0 +1,230 @@
+import os
+from typing import NamedTuple, Optional, Tuple
+import click
+import numpy as np
+import cv2 as cv
+from .compensation import (DEFAULT_PRESET, defaultCorners, maskFormat, maskMetadataPath,
+                           nativeSize, orientMask, quantizeMask, readMaskMetadata,
+                           screenTransform, writeMask, writeMaskMetadata)
+from .io import loadMeasurement
+
+# Plausible exponents of the mask -> irradiance response; fits outside fall
+# back to a linear response
+GAMMA_RANGE = (0.3, 5.0)
+# Minimal spread of mask values (0-255) for fitting the exponent
+MIN_MASK_SPREAD = 4.0
+
+class ResponseFit(NamedTuple):
+    """
+    Irradiance ratio (with mask / without mask) modelled as
+    scale * (mask / 255) ** gamma
+    """
+    gamma: float
+    scale: float
+    r2: float
+    samples: int
+    fitted: bool  # False when the linear fallback is used
+
+    def __call__(self, mask: np.ndarray) -> np.ndarray:
+        return self.scale * (np.asarray(mask) / 255) ** self.gamma
+
+class Uniformity(NamedTuple):
+    mean: float
+    cv: float  # Standard deviation relative to the mean
+    nonuniformity: float  # (max - min) / (max + min)
+    spread: float  # (95th - 5th percentile) relative to the median
+
+    @staticmethod
+    def of(values: np.ndarray) -> "Uniformity":
+        values = values[np.isfinite(values)]
+        low, median, high = np.percentile(values, [5, 50, 95])
+        return Uniformity(float(np.mean(values)), float(np.std(values) / np.mean(values)),
+                          float((values.max() - values.min()) / (values.max() + values.min())),
+                          float((high - low) / median))
+
+def readMask(path: str, encoding: Optional[dict] = None) -> np.ndarray:
+    """
+    Read a mask image as float values 0-255 in screen orientation (i.e., undo
+    the orientation for the printer). Raw masks have no header; their shape
+    and bit depth come from the encoding stored in the mask metadata.
+    """
+    if maskFormat(path) == "raw":
+        if not encoding or "shape" not in encoding:
+            raise ValueError(f"Cannot read raw mask {path} without the shape in its metadata")
+        dtype = np.dtype("<u2" if encoding.get("depth", 8) == 16 else "u1")
+        mask = np.fromfile(path, dtype=dtype)
+        if mask.size != np.prod(encoding["shape"]):
+            raise ValueError(f"Raw mask {path} does not match the shape {encoding['shape']} in its metadata")
+        mask = mask.reshape(encoding["shape"]).astype(dtype.newbyteorder("="))
+    else:
+        mask = cv.imread(path, cv.IMREAD_UNCHANGED)
+    if mask is None:
+        raise ValueError(f"Cannot read mask {path}")
+    if mask.ndim == 3:
+        mask = cv.cvtColor(mask, cv.COLOR_BGR2GRAY)
+    scale = 255 / np.iinfo(mask.dtype).max if mask.dtype.kind in "ui" else 255
+    return orientMask(mask).astype(np.float32) * np.float32(scale)
+
+def maskPerCell(mask: np.ndarray, transform: np.ndarray, corners, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Average the mask over the area each measurement cell sees. Cells outside
+    of the screen are NaN.
+    """
+    size = nativeSize(corners)
+    cell = (max(1, round(mask.shape[1] / size[0])), max(1, round(mask.shape[0] / size[1])))
+    averaged = cv.blur(mask, cell)
+    return cv.warpPerspective(averaged, transform, (shape[1], shape[0]),
+                              flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP,
+                              borderMode=cv.BORDER_CONSTANT, borderValue=np.nan)
+
+def fitResponse(cellMask: np.ndarray, ratio: np.ndarray) -> ResponseFit:
+    """
+    Fit the power-law response in log space over the valid cells
+    """
+    valid = np.isfinite(cellMask) & np.isfinite(ratio) & (cellMask > 0) & (ratio > 0)
+    x = np.log(cellMask[valid] / 255)
+    y = np.log(ratio[valid])
+    samples = int(valid.sum())
+    if samples >= 3 and np.ptp(cellMask[valid]) >= MIN_MASK_SPREAD:
+        gamma, offset = np.polyfit(x, y, 1)
+        if GAMMA_RANGE[0] <= gamma <= GAMMA_RANGE[1]:
+            residual = y - (gamma * x + offset)
+            r2 = 1 - np.sum(residual ** 2) / max(np.sum((y - y.mean()) ** 2), 1e-12)
+            return ResponseFit(float(gamma), float(np.exp(offset)), float(r2), samples, True)
+    # Linear response; only the overall transmission is fitted
+    offset = float(np.mean(y - x)) if samples else 0.0
+    return ResponseFit(1.0, float(np.exp(offset)), float("nan"), samples, False)
+
+class RefineResult(NamedTuple):
+    mask: np.ndarray  # uint8 or uint16 by depth, screen orientation
+    fit: ResponseFit
+    target: float
+    baseline: Uniformity
+    current: Uniformity
+    predicted: Uniformity
+    clipped: float  # Fraction of cells that cannot reach the target
+
+def refineMask(baseline: np.ndarray, measured: np.ndarray, mask: np.ndarray, corners,
+               target: Optional[float] = None, targetPercentile: float = 5, gain: float = 1.0,
+               minValue: int = 0, maxValue: int = 255, depth: int = 8) -> RefineResult:
+    """
+    Update the mask so the irradiance measured with it approaches the target.
+    The per-cell correction follows from the fitted response:
+    mask' = mask * (target / measured) ** (gain / gamma), applied on screen
+    pixels after interpolating the correction from the measurement grid.
+    """
+    screenSize = (mask.shape[1], mask.shape[0])
+    transform = screenTransform(corners, screenSize)
+    cellMask = maskPerCell(mask, transform, corners, measured.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = measured / baseline
+    fit = fitResponse(cellMask, ratio)
+
+    inside = np.isfinite(cellMask) & np.isfinite(measured)
+    if target is None:
+        target = float(np.percentile(measured[inside], targetPercentile))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correction = (target / measured) ** (gain / fit.gamma)
+    correction[~np.isfinite(correction)] = 1.0
+
+    screenCorrection = cv.warpPerspective(correction.astype(np.float32), transform, screenSize,
+                                          flags=cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+    refined = np.clip(mask * screenCorrection, minValue, maxValue)
+
+    newCellMask = maskPerCell(refined.astype(np.float32), transform, corners, measured.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        predicted = measured * fit(newCellMask) / fit(cellMask)
+        clipped = np.mean(cellMask[inside] * correction[inside] > maxValue)
+    return RefineResult(quantizeMask(refined, depth), fit, target,
+                        Uniformity.of(baseline[inside]), Uniformity.of(measured[inside]),
+                        Uniformity.of(predicted[inside]), float(clipped))
+
+def printRefinement(result: RefineResult) -> None:
+    fit = result.fit
+    print("\nMask response fit:")
+    if fit.fitted:
+        print(f"- Irradiance ratio = {fit.scale:.3f} * (mask / 255) ^ {fit.gamma:.2f} "
+              f"(R² {fit.r2:.3f}, {fit.samples} cells)")
+    else:
+        print(f"- Mask values too uniform to fit an exponent, assuming a linear response "
+              f"(transmission {fit.scale:.3f}, {fit.samples} cells)")
+    print(f"- Target irradiance: {result.target:.3f} mW")
+    if result.clipped > 0:
+        print(f"- {result.clipped * 100:.1f}% of cells need more than the maximal brightness")
+
+    print(f"\n{'scan':>10} {'mean [mW]':>10} {'CV [%]':>8} {'(max-min)/(max+min) [%]':>24} {'p95-p5 [%]':>11}")
+    for name, u in [("baseline", result.baseline), ("current", result.current), ("predicted", result.predicted)]:
+        print(f"{name:>10} {u.mean:>10.3f} {u.cv * 100:>8.2f} {u.nonuniformity * 100:>24.2f} {u.spread * 100:>11.2f}")
+
+@click.command()
+@click.argument("output", type=click.Path())
+@click.option("--baseline", type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True,
+    help="Measurement without the mask")
+@click.option("--mask", "mask_path", type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True,
+    help="The current mask")
+@click.option("--measured", type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True,
+    help="Measurement taken with the current mask")
+@click.option("--target", type=float, default=None,
+    help="Target irradiance in mW (default: the target of the previous refinement or a percentile of the measurement with the mask)")
+@click.option("--target-percentile", type=float, default=5,
+    help="Percentile of the measurement with the mask used as the target")
+@click.option("--gain", type=click.FloatRange(0, 1), default=1.0,
+    help="Fraction of the correction to apply; lower values damp oscillations")
+@click.option("--min", "min_value", type=int, default=0,
+    help="The minimal brightness value (0-255)")
+@click.option("--max", "max_value", type=int, default=255,
+    help="The maximal brightness value (0-255)")
+def refine(output, baseline, mask_path, measured, target, target_percentile, gain, min_value, max_value):
+    """
+    Refine a compensation mask from a measurement taken with it. Fits how the
+    mask brightness changes the irradiance and writes an updated mask that
+    drives the residual non-uniformity towards the target.
+    """
+    baselineData = loadMeasurement(baseline).values
+    measuredData = loadMeasurement(measured).values
+    if baselineData.shape != measuredData.shape:
+        raise click.BadParameter("The measurements have different resolutions", param_hint="--measured")
+    metadata = readMaskMetadata(mask_path) if os.path.exists(maskMetadataPath(mask_path)) else {}
+    corners = metadata.get("corners") or defaultCorners(baselineData)
+    history = metadata.get("refinements", [])
+    encoding = metadata.get("encoding", {})
+    try:
+        mask = readMask(mask_path, encoding)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--mask")
+    preset, depth = encoding.get("preset", DEFAULT_PRESET), encoding.get("depth", 8)
+    if target is None and history:
+        # Keep the target of the previous iterations so they converge
+        target = history[-1]["target"]
+
+    result = refineMask(baselineData, measuredData, mask, corners, target, target_percentile,
+                        gain, min_value, max_value, depth)
+    printRefinement(result)
+    if history:
+        expected = history[-1]["predicted"]["cv"]
+        print(f"\nPrevious iteration predicted CV {expected * 100:.2f}%, "
+              f"measured {result.current.cv * 100:.2f}%")
+
+    writeMask(output, orientMask(result.mask), preset)
+    writeMaskMetadata(output, {
+        **metadata,
+        "min": min_value,
+        "max": max_value,
+        "encoding": {
+            "format": maskFormat(output),
+            "preset": preset,
+            "depth": depth,
+            "shape": list(result.mask.shape)
+        },
+        "refinements": history + [{
+            "baseline": os.path.abspath(baseline),
+            "mask": os.path.abspath(mask_path),
+            "measured": os.path.abspath(measured),
+            "target": result.target,
+            "gain": gain,
+            "fit": result.fit._asdict(),
+            "current": result.current._asdict(),
+            "predicted": result.predicted._asdict()
+        }]
+    })
+    print(f"\nRefined mask written to {output} (iteration {len(history) + 1})")
@@ -0,0 +1,109 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from scipy.interpolate import griddata
+
+LatticePoint = Tuple[int, int]
+
+class AdaptivePlanner:
+    """
+    Coarse-to-fine sampling planner. The samples live on the lattice of the
+    target resolution; the first pass measures every `coarseStride`-th lattice
+    point and every following pass adds up to `batchSize` points where the
+    interpolation error is estimated to be the largest.
+
+    The error estimate at an unmeasured lattice point is the difference between
+    the linear and the cubic interpolant of the samples taken so far. It is
+    large on LED edges and hot spots and vanishes where the backlight is
+    smooth. Planning stops when no estimate exceeds the tolerance or the sample
+    budget is exhausted.
+    """
+    def __init__(self, size: Tuple[float, float], resolution: Tuple[int, int],
+                 coarseStride: int = 4, tolerance: float = 0.05,
+                 batchSize: int = 50, budget: Optional[int] = None) -> None:
+        self.size = size
+        self.resolution = resolution
+        self.coarseStride = max(1, coarseStride)
+        self.tolerance = tolerance
+        self.batchSize = batchSize
+        self.budget = budget if budget is not None else resolution[0] * resolution[1]
+
+    def position(self, point: LatticePoint) -> Tuple[float, float]:
+        """
+        Return the position of a lattice point in mm
+        """
+        ix, iy = point
+        return (ix * self.size[0] / max(self.resolution[0] - 1, 1),
+                iy * self.size[1] / max(self.resolution[1] - 1, 1))
+
+    def initialPoints(self) -> List[LatticePoint]:
+        """
+        Points of the coarse pass, the lattice border is always included
+        """
+        def axis(n):
+            return sorted(set(range(0, n, self.coarseStride)) | {n - 1})
+        return [(ix, iy) for iy in axis(self.resolution[1]) for ix in axis(self.resolution[0])]
+
+    def errorEstimate(self, measured: Dict[LatticePoint, float]) -> np.ndarray:
+        """
+        Return the estimated interpolation error on the whole lattice, shape
+        (rows, columns). Measured points have zero error; failed samples are
+        stored as NaN and are not used for the estimate.
+        """
+        cols, rows = self.resolution
+        points = np.array(list(measured.keys()), dtype=float)
+        values = np.array(list(measured.values()), dtype=float)
+        valid = ~np.isnan(values)
+        gridX, gridY = np.meshgrid(np.arange(cols), np.arange(rows))
+        linear = griddata(points[valid], values[valid], (gridX, gridY), method="linear")
+        cubic = griddata(points[valid], values[valid], (gridX, gridY), method="cubic")
+        error = np.nan_to_num(np.abs(cubic - linear), nan=0.0)
+        measuredIdx = points.astype(int)
+        error[measuredIdx[:, 1], measuredIdx[:, 0]] = 0
+        return error
+
+    def nextPoints(self, measured: Dict[LatticePoint, float]) -> List[LatticePoint]:
+        """
+        Given the samples taken so far, return the points of the next pass.
+        An empty list means the measurement is complete.
+        """
+        remaining = self.budget - len(measured)
+        if remaining <= 0 or np.count_nonzero(~np.isnan(list(measured.values()))) < 4:
+            return []
+        error = self.errorEstimate(measured)
+        rows, cols = np.nonzero(error > self.tolerance)
+        if len(rows) == 0:
+            return []
+        order = np.argsort(-error[rows, cols], kind="stable")
+        candidates = np.stack([cols[order], rows[order]], axis=1)
+
+        # Spread the batch out, neighbors of a picked point share its error
+        spacing = max(1, self.coarseStride // 2)
+        picked = np.empty((0, 2), dtype=int)
+        limit = min(self.batchSize, remaining)
+        for candidate in candidates:
+            if len(picked) > 0 and np.min(np.max(np.abs(picked - candidate), axis=1)) < spacing:
+                continue
+            picked = np.vstack([picked, candidate])
+            if len(picked) >= limit:
+                break
+        return [(int(ix), int(iy)) for ix, iy in picked]
+
+def regridScattered(x: np.ndarray, y: np.ndarray, values: np.ndarray,
+                    size: Tuple[float, float], resolution: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Interpolate scattered samples (positions in mm) onto the regular grid of
+    given size and resolution. Returns the value, x and y planes. Grid points
+    outside of the convex hull of the samples take the nearest sample.
+    """
+    xs = np.linspace(0, size[0], resolution[0])
+    ys = np.linspace(0, size[1], resolution[1])
+    gridX, gridY = np.meshgrid(xs, ys)
+    points = np.stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)], axis=1)
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    points, values = points[valid], values[valid]
+    grid = griddata(points, values, (gridX, gridY), method="cubic")
+    missing = np.isnan(grid)
+    if missing.any():
+        grid[missing] = griddata(points, values, (gridX[missing], gridY[missing]), method="nearest")
+    return grid, gridX, gridY
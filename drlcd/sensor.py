@@ -2,13 +2,162 @@ import serial
 import time
 import csv
 import threading
+import statistics
 from contextlib import contextmanager
-from typing import Generator, Optional
+from typing import Generator, List, NamedTuple, Optional, Tuple
+
+HISTORY_LENGTH = 100000
+
+class Reading(NamedTuple):
+    timestamp: float  # time.monotonic() when the reading was received
+    value: float
+    raw: Tuple[str, ...]  # All fields of the sensor line
+
+class ReadingBuffer:
+    """
+    A fixed-size ring buffer of sensor readings shared between the reading
+    thread and the consumers. Every reading gets a sequence number; consumers
+    remember the sequence they have seen and block on a condition variable
+    until new readings arrive.
+    """
+    def __init__(self, capacity: int = HISTORY_LENGTH) -> None:
+        self._capacity = capacity
+        self._records: List[Optional[Reading]] = [None] * capacity
+        self._count = 0
+        self._condition = threading.Condition()
+
+    @property
+    def sequence(self) -> int:
+        """
+        The sequence number the next reading will get
+        """
+        with self._condition:
+            return self._count
+
+    def append(self, reading: Reading) -> None:
+        with self._condition:
+            self._records[self._count % self._capacity] = reading
+            self._count += 1
+            self._condition.notify_all()
+
+    def _after(self, sequence: int) -> List[Reading]:
+        # The caller holds the lock; older readings might be overwritten
+        first = max(sequence, self._count - self._capacity, 0)
+        return [self._records[i % self._capacity] for i in range(first, self._count)]
+
+    def _newest_first(self):
+        oldest = max(self._count - self._capacity, 0)
+        for i in range(self._count - 1, oldest - 1, -1):
+            yield self._records[i % self._capacity]
+
+    def latest(self) -> Optional[Reading]:
+        with self._condition:
+            return self._records[(self._count - 1) % self._capacity] if self._count > 0 else None
+
+    def after(self, sequence: int) -> Tuple[List[Reading], int]:
+        """
+        Return the readings with sequence number at least `sequence` and the
+        sequence number to continue from.
+        """
+        with self._condition:
+            return self._after(sequence), self._count
+
+    def between(self, start: float, end: float) -> List[Reading]:
+        """
+        Return readings received in [start, end] ordered by time
+        """
+        with self._condition:
+            result = []
+            for reading in self._newest_first():
+                if reading.timestamp < start:
+                    break
+                if reading.timestamp <= end:
+                    result.append(reading)
+        result.reverse()
+        return result
+
+    def since(self, start: float) -> List[Reading]:
+        return self.between(start, float("inf"))
+
+    def wait_for(self, count: int, after: Optional[int] = None,
+                 timeout: Optional[float] = None) -> Tuple[List[Reading], int]:
+        """
+        Block until `count` readings newer than sequence `after` (default: now)
+        arrive or the timeout expires. Return the new readings and the sequence
+        number to continue from.
+        """
+        with self._condition:
+            if after is None:
+                after = self._count
+            self._condition.wait_for(lambda: self._count - after >= count, timeout)
+            return self._after(after), self._count
+
+    def median(self, start: float, end: Optional[float] = None) -> Optional[float]:
+        """
+        Median of the values received within the time window; None if there
+        are no readings in it.
+        """
+        values = [r.value for r in self.between(start, end if end is not None else float("inf"))]
+        return statistics.median(values) if values else None
+
+class SettleResult(NamedTuple):
+    value: Optional[float]  # Median of the settled window
+    settled: bool
+    elapsed: float  # Seconds from the start of waiting to the decision
+    window: List[Reading]
+
+def _drift(window: List[Reading]) -> float:
+    """
+    Change of the least-squares line fitted through the window over its span
+    """
+    n = len(window)
+    meanT = sum(r.timestamp for r in window) / n
+    meanV = sum(r.value for r in window) / n
+    varT = sum((r.timestamp - meanT) ** 2 for r in window)
+    if varT == 0:
+        return 0.0
+    slope = sum((r.timestamp - meanT) * (r.value - meanV) for r in window) / varT
+    return slope * (window[-1].timestamp - window[0].timestamp)
+
+def wait_for_settle(readings: ReadingBuffer, tolerance: float, window: int = 3,
+                    min_delay: float = 0.0, timeout: float = 5.0,
+                    threshold: Optional[float] = None) -> SettleResult:
+    """
+    Wait until the sensor value settles. The value is settled when the last
+    `window` readings spread less than tolerance, their fitted drift is below
+    tolerance and their median is above the threshold. Readings received
+    within min_delay are ignored. Returns as soon as the criterion is met or
+    when the timeout expires; in that case the last median is reported with
+    `settled` false. The window needs at least one reading.
+    """
+    if window < 1:
+        raise ValueError(f"The settle window needs at least one reading, got {window}")
+    start = time.monotonic()
+    deadline = start + timeout
+    sequence = readings.sequence
+    recent: List[Reading] = []
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        new, sequence = readings.wait_for(1, after=sequence, timeout=remaining)
+        recent.extend(r for r in new if r.timestamp >= start + min_delay)
+        recent = recent[-window:]
+        if len(recent) < window:
+            continue
+        values = [r.value for r in recent]
+        median = statistics.median(values)
+        if max(values) - min(values) < tolerance and abs(_drift(recent)) < tolerance \
+                and (threshold is None or median > threshold):
+            return SettleResult(median, True, time.monotonic() - start, recent)
+    median = statistics.median([r.value for r in recent]) if recent else None
+    return SettleResult(median, False, time.monotonic() - start, recent)
 
 class Sensor:
     def __init__(self) -> None:
         try:
-            self.latest_reading = None
+            self.readings = ReadingBuffer()
+            self._consumed = 0  # Sequence of the first reading not returned yet
             self.running = True
             self.thread = threading.Thread(target=self._read_data_thread, daemon=True)
             self.thread.start()
@@ -42,7 +191,7 @@ class Sensor:
         values = line.split(';')
         time.sleep(1)
         if len(values) > 6:
-            self.latest_reading = float(values[1])
+            self._record(values)
         time.sleep(3)
 
         while self.running:
@@ -51,13 +200,30 @@ class Sensor:
                 if line and "Datarecording" not in line:
                     values = line.split(';')
                     if len(values) > 6:
-                        self.latest_reading = float(values[1])
+                        self._record(values)
             except Exception as e:
                 print(f"Fehler beim Lesen der Daten: {e}")
 
-    def get_latest_reading(self) -> Optional[list]:
-        while self.latest_reading == None:
-            time.sleep(0.1)
-        last_reading = self.latest_reading
-        self.latest_reading = None
-        return last_reading
+    def _record(self, values: List[str]) -> None:
+        self.readings.append(Reading(time.monotonic(), float(values[1]), tuple(values)))
+
+    @property
+    def latest_reading(self) -> Optional[float]:
+        latest = self.readings.latest()
+        return latest.value if latest is not None else None
+
+    def readings_between(self, start: float, end: float) -> List[Reading]:
+        """
+        Return the readings received in [start, end]
+        """
+        return self.readings.between(start, end)
+
+    def get_latest_reading(self, timeout: Optional[float] = None) -> Optional[float]:
+        """
+        Return the newest reading not returned before; block until one arrives.
+        Readings in between are skipped. Return None on timeout.
+        """
+        new, self._consumed = self.readings.wait_for(1, after=self._consumed, timeout=timeout)
+        if not new:
+            return None
+        return new[-1].value
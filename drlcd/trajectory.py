@@ -0,0 +1,87 @@
+from typing import List, Sequence, Tuple
+import numpy as np
+
+class Sweep:
+    """
+    A straight constant-velocity move of the sensor from start to end
+    (machine coordinates in mm) that started at monotonic time tStart and
+    finished at tEnd.
+
+    The motion is modeled as a symmetric trapezoidal velocity profile with a
+    given acceleration ramp duration; a zero ramp means constant velocity over
+    the whole move.
+    """
+    def __init__(self, start: Tuple[float, float], end: Tuple[float, float],
+                 tStart: float, tEnd: float, ramp: float = 0) -> None:
+        assert tEnd > tStart
+        self.start = np.asarray(start, dtype=float)
+        self.end = np.asarray(end, dtype=float)
+        self.tStart = tStart
+        self.tEnd = tEnd
+        self.ramp = min(max(ramp, 0), (tEnd - tStart) / 2)
+
+    @property
+    def duration(self) -> float:
+        return self.tEnd - self.tStart
+
+    def progress(self, times: Sequence[float]) -> np.ndarray:
+        """
+        Return the traveled fraction (0-1) of the move at given times. Times
+        outside the move are clamped.
+        """
+        t = np.clip(np.asarray(times, dtype=float) - self.tStart, 0, self.duration)
+        total, ramp = self.duration, self.ramp
+        if ramp == 0:
+            return t / total
+        # Distance covered at cruise velocity v is v * (total - ramp)
+        v = 1 / (total - ramp)
+        a = v / ramp
+        accelerating = 0.5 * a * t ** 2
+        cruising = 0.5 * a * ramp ** 2 + v * (t - ramp)
+        decelerating = 1 - 0.5 * a * (total - t) ** 2
+        return np.where(t < ramp, accelerating,
+                        np.where(t > total - ramp, decelerating, cruising))
+
+    def positionAt(self, times: Sequence[float]) -> np.ndarray:
+        """
+        Return the (x, y) positions for given times as an array of shape (n, 2)
+        """
+        p = self.progress(times)[:, None]
+        return self.start + p * (self.end - self.start)
+
+def binReadings(positions: np.ndarray, values: np.ndarray,
+                targets: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Given 1D reading positions and values, return the mean of readings within
+    radius of each target position and the number of such readings. Targets
+    without a reading get NaN.
+    """
+    targets = np.asarray(targets, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(positions)
+    positions, values = positions[order], values[order]
+    cumulative = np.concatenate([[0], np.cumsum(values)])
+    lo = np.searchsorted(positions, targets - radius, side="left")
+    hi = np.searchsorted(positions, targets + radius, side="right")
+    counts = hi - lo
+    sums = cumulative[hi] - cumulative[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan), counts
+
+def mapSweepReadings(sweep: Sweep, readings: List[Tuple[float, float]],
+                     targets: np.ndarray, radius: float, axis: int = 0,
+                     latency: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Map timestamped readings (time, value) taken during a sweep onto target
+    coordinates along the given axis. The sensor latency is subtracted from the
+    reading timestamps first. Returns the binned values and the number of
+    readings in each bin.
+    """
+    if len(readings) == 0:
+        return np.full(len(targets), np.nan), np.zeros(len(targets), dtype=int)
+    times = np.array([r[0] for r in readings]) - latency
+    values = np.array([r[1] for r in readings])
+    inside = (times >= sweep.tStart) & (times <= sweep.tEnd)
+    positions = sweep.positionAt(times[inside])[:, axis]
+    return binReadings(positions, values[inside], targets, radius)
@@ -1,7 +1,15 @@
 from nicegui import ui
+import click
 from .machine import Machine
-from .sensor import Sensor
-import json
+from .sensor import Sensor, wait_for_settle
+from .io import MeasurementWriter, loadMeasurement, partialPath, readPartialMeasurement
+from .trajectory import Sweep, mapSweepReadings
+from .sampling import AdaptivePlanner
+from .path import STRATEGIES, planPath, travelTime
+import numpy as np
+import cv2 as cv
+import base64
+import os
 from time import sleep
 
 
@@ -20,11 +28,24 @@ class LCDController:
         self.size_y = 129  # Default size
         self.resolution_x = self.size_x // 7  # Default resolution
         self.resolution_y = self.size_y // 7  # Default resolution
-        self.sleeptime = 1.0
+        self.sleeptime = 0.2  # Minimal delay before readings count towards settling
+        self.settle_window = 3  # Number of consecutive readings that have to agree
+        self.settle_timeout = 5.0  # Per-point settle timeout in seconds
+        self.settle_retries = 2  # Re-lower the sensor this many times if it does not settle
         self.brightness_threshold = 0.5
         self.filename = "measurement.json"
         self.sensor = None
         self.sensor_accuracy = 0.1  # Default sensor accuracy threshold
+        self.resume_file = ''  # Row log of an interrupted measurement
+        self.scan_mode = 'point'  # 'point' stops at every sample, 'flying' sweeps rows
+        self.sweep_speed = 10  # Pen-down speed of flying scans in percent
+        self.sweep_ramp = 0.1  # Acceleration ramp duration of a sweep in seconds
+        self.sensor_latency = 0.0  # Delay between light hitting the sensor and the reading in seconds
+        self.coarse_stride = 4  # Adaptive scans start with every n-th grid point
+        self.refine_tolerance = 0.05  # Adaptive scans refine where the interpolation error exceeds this
+        self.refine_batch = 50  # Points added per refinement pass
+        self.path_strategy = 'serpentine'  # Visiting order of point-by-point scans
+        self.corner_tour = True  # Visit the corners of the scanned area before starting
     
     def connect_machine(self):
         self.machine = Machine()
@@ -111,6 +132,186 @@ class LCDController:
         self.current_y = y
         ui.notify(f'Moved to {corner} corner')
 
+    def measure_point(self):
+        """
+        Lower the sensor and wait until the reading settles. If it does not
+        settle in time, lift the sensor, lower it again and retry.
+        """
+        for attempt in range(int(self.settle_retries) + 1):
+            self.machine.start_measure()
+            result = wait_for_settle(self.sensor.readings, self.sensor_accuracy,
+                                     window=int(self.settle_window),
+                                     min_delay=self.sleeptime,
+                                     timeout=self.settle_timeout,
+                                     threshold=self.brightness_threshold)
+            self.machine.stop_measure()
+            if result.settled:
+                break
+            print(f"Warning: reading did not settle in {self.settle_timeout} s (attempt {attempt + 1})")
+        return result
+
+    def measure_grid_point(self, x, y, step_x, step_y):
+        """
+        Move to the grid point and measure it. Return the point record, an
+        empty one if there was no reading.
+        """
+        pos_x = x * step_x
+        pos_y = y * step_y
+        
+        x_inch = (pos_x + self.origin_offset[0]) * mm_to_inch_x
+        y_inch = (pos_y + self.origin_offset[1]) * mm_to_inch_y
+
+        self.machine.move_to(x_inch, y_inch)
+        print("moved to", x_inch, y_inch)
+        result = self.measure_point()
+        print(f"{x}, {y}: {result.value} settled in {result.elapsed:.2f} s")
+        if result.value is None:
+            return {}
+
+        return {
+            'value': result.value,
+            'x': pos_x,
+            'y': pos_y,
+            'settle_time': round(result.elapsed, 3)
+        }
+
+    def measure_grid_points(self, writer, step_x, step_y):
+        """
+        Measure all grid points missing in the log point by point, visiting
+        them in the order given by the path strategy. The touched rows are
+        persisted after every resolution_x points.
+        """
+        rows = {y: list(writer.rows.get(y, [{} for _ in range(self.resolution_x)]))
+                for y in range(self.resolution_y)}
+        missing = [(x, y) for y in range(self.resolution_y) for x in range(self.resolution_x)
+                   if not rows[y][x]]
+        if not missing:
+            return
+        positions = [(x * step_x, y * step_y) for x, y in missing]
+        order = planPath(positions, self.path_strategy)
+        estimate = travelTime(positions, order, dwell=self.sleeptime)
+        print(f"Measuring {len(missing)} points along a {self.path_strategy} path, "
+              f"estimated at least {estimate / 60:.1f} min")
+
+        touched = set()
+        for count, i in enumerate(order, 1):
+            x, y = missing[i]
+            rows[y][x] = self.measure_grid_point(x, y, step_x, step_y)
+            touched.add(y)
+            # Persist regularly, a crash loses at most one row worth of points
+            if count % self.resolution_x == 0 or count == len(order):
+                for t in sorted(touched):
+                    writer.writeRow(t, rows[t])
+                touched.clear()
+
+    def measure_row_flying(self, y, step_x, step_y):
+        """
+        Sweep a row at constant velocity and map the timestamped sensor
+        readings onto the row samples by interpolating the commanded
+        trajectory. Odd rows are swept right to left. Dark readings are kept
+        as values, a sample is empty only if no reading falls into its window.
+        """
+        pos_y = y * step_y
+        start_x, end_x = (0, self.size_x) if y % 2 == 0 else (self.size_x, 0)
+        y_inch = (pos_y + self.origin_offset[1]) * mm_to_inch_y
+
+        self.machine.move_to((start_x + self.origin_offset[0]) * mm_to_inch_x, y_inch)
+        self.machine.start_measure()
+        t_start, t_end = self.machine.sweep_to((end_x + self.origin_offset[0]) * mm_to_inch_x, y_inch)
+        # Wait for the readings delayed by the sensor latency
+        sleep(self.sensor_latency)
+        self.machine.stop_measure()
+
+        sweep = Sweep((start_x, pos_y), (end_x, pos_y), t_start, t_end, ramp=self.sweep_ramp)
+        readings = self.sensor.readings_between(t_start, t_end + self.sensor_latency)
+        columns = np.arange(self.resolution_x) * step_x
+        values, counts = mapSweepReadings(sweep, readings, columns, step_x / 2,
+                                          latency=self.sensor_latency)
+        print(f"Row {y}: {len(readings)} readings in {t_end - t_start:.1f} s")
+        missing = int(np.sum(counts == 0))
+        if missing > 0:
+            print(f"Warning: {missing} samples in row {y} got no reading, lower the sweep speed")
+
+        return [
+            {'value': float(values[x]), 'x': x * step_x, 'y': pos_y} if counts[x] > 0 else {}
+            for x in range(self.resolution_x)
+        ]
+
+    def measure_rows(self, writer, step_x, step_y):
+        """
+        Scan the full grid, skipping points already in the log. Flying scans
+        sweep every row that is not complete.
+        """
+        if self.scan_mode != 'flying':
+            self.measure_grid_points(writer, step_x, step_y)
+            return
+        for y in range(self.resolution_y):
+            if y in writer.rows and all(writer.rows[y]):
+                continue
+            row = self.measure_row_flying(y, step_x, step_y)
+            # Persist every finished row, a crash loses at most the current one
+            writer.writeRow(y, row)
+
+    def measure_adaptive(self, writer):
+        """
+        Coarse-to-fine scan: measure a coarse grid first, then keep adding the
+        points the planner picks until the estimated interpolation error drops
+        under the tolerance. Every pass is persisted as one record of the log.
+        """
+        planner = AdaptivePlanner((self.size_x, self.size_y), (self.resolution_x, self.resolution_y),
+                                  coarseStride=int(self.coarse_stride),
+                                  tolerance=self.refine_tolerance,
+                                  batchSize=int(self.refine_batch))
+        measured = {
+            (p['ix'], p['iy']): p.get('value', float('nan'))
+            for points in writer.rows.values() for p in points
+        }
+        next_pass = max(writer.rows) + 1 if writer.rows else 0
+        batch = planner.initialPoints() if next_pass == 0 else planner.nextPoints(measured)
+        position = (0, 0)
+        while batch:
+            positions = [planner.position(p) for p in batch]
+            batch = [batch[i] for i in planPath(positions, self.path_strategy, start=position)]
+            points = []
+            for ix, iy in batch:
+                pos_x, pos_y = planner.position((ix, iy))
+                x_inch = (pos_x + self.origin_offset[0]) * mm_to_inch_x
+                y_inch = (pos_y + self.origin_offset[1]) * mm_to_inch_y
+                self.machine.move_to(x_inch, y_inch)
+                result = self.measure_point()
+                print(f"{ix}, {iy}: {result.value} settled in {result.elapsed:.2f} s")
+                point = {'ix': ix, 'iy': iy}
+                if result.value is not None:
+                    point.update({
+                        'value': result.value,
+                        'x': pos_x,
+                        'y': pos_y,
+                        'settle_time': round(result.elapsed, 3)
+                    })
+                points.append(point)
+                measured[(ix, iy)] = point.get('value', float('nan'))
+                position = (pos_x, pos_y)
+            writer.writeRow(next_pass, points)
+            print(f"Pass {next_pass}: {len(batch)} points, {len(measured)} in total")
+            next_pass += 1
+            batch = planner.nextPoints(measured)
+
+    def load_resume(self, path):
+        """
+        Take the scan parameters from the row log of an interrupted measurement
+        so the next start continues it.
+        """
+        metadata, rows, _ = readPartialMeasurement(path)
+        self.size_x, self.size_y = metadata["size"]
+        self.resolution_x, self.resolution_y = metadata["resolution"]
+        self.origin_offset = tuple(metadata.get("origin_offset", self.origin_offset))
+        if metadata.get("layout") == "scattered":
+            self.scan_mode = 'adaptive'
+        if path.endswith(partialPath("")):
+            self.filename = path[:-len(partialPath(""))]
+        self.resume_file = path
+        print(f"Resuming {path}: {len(rows)} of {self.resolution_y} rows captured")
+
     def start_measurement(self):
         if self.machine is None:
             ui.notify('Please connect to machine first!')
@@ -120,15 +321,22 @@ class LCDController:
             ui.notify('Please connect to sensor first!')
             return
 
-        self.move_to_corner('bottom_right')
-        sleep(1)
-        self.move_to_corner('bottom_left')
-        sleep(1)
-        self.move_to_corner('top_left')
-        sleep(1)
-        self.move_to_corner('top_right')
-        sleep(1)
-        self.move_to_corner('bottom_right')
+        if int(self.settle_window or 0) < 1:
+            ui.notify('The settle window needs at least one reading!')
+            return
+
+        if not self.resume_file and os.path.exists(partialPath(self.filename)):
+            ui.notify(f'{partialPath(self.filename)} holds an unfinished measurement; '
+                      'resume it or move it away first!')
+            return
+
+        if self.resume_file:
+            self.load_resume(self.resume_file)
+            writer = MeasurementWriter.resume(self.resume_file)
+        elif self.corner_tour:
+            # Show the scanned area before starting
+            for corner in ['bottom_right', 'bottom_left', 'top_left', 'top_right', 'bottom_right']:
+                self.move_to_corner(corner)
 
         self.resolution_x = int(self.resolution_x)
         self.resolution_y = int(self.resolution_y)
@@ -136,54 +344,131 @@ class LCDController:
         step_x = self.size_x / (self.resolution_x - 1)
         step_y = self.size_y / (self.resolution_y - 1)
         
-        measurements = [[{} for _ in range(self.resolution_x)] for _ in range(self.resolution_y)]
-        
-        for y in range(self.resolution_y):
-            for x in range(self.resolution_x):
-                pos_x = x * step_x
-                pos_y = y * step_y
-                
-                x_inch = (pos_x + self.origin_offset[0]) * mm_to_inch_x
-                y_inch = (pos_y + self.origin_offset[1]) * mm_to_inch_y
+        if self.scan_mode == 'flying':
+            self.machine.set_sweep_speed(self.sweep_speed)
 
-                self.machine.move_to(x_inch, y_inch)
-                print("moved to", x_inch, y_inch)
-                self.machine.start_measure()
-                sleep(self.sleeptime)
-
-                while True:
-                    data1 = self.sensor.get_latest_reading()
-                    data2 = self.sensor.get_latest_reading()
-                    data3 = self.sensor.get_latest_reading()
-                    print(data1, data2, data3)
-                    if abs(data1 - data2) < self.sensor_accuracy and abs(data2 - data3) < self.sensor_accuracy:
-                        if data2 > self.brightness_threshold:
-                            break
-
-                self.machine.stop_measure()
-
-                measurements[y][x] = {
-                    'value': data2,
-                    'x': x * step_x,
-                    'y': y * step_y
-                }
+        if not self.resume_file:
+            metadata = {
+                "sensor": "TSL2561",
+                "size": [self.size_x, self.size_y],
+                "resolution": [self.resolution_x, self.resolution_y],
+                "origin_offset": list(self.origin_offset)
+            }
+            if self.scan_mode == 'adaptive':
+                metadata["layout"] = "scattered"
+            writer = MeasurementWriter(partialPath(self.filename), metadata)
         
-        result = {
-            "sensor": "TSL2561",
-            "size": [self.size_x, self.size_y],
-            "resolution": [self.resolution_x, self.resolution_y],
-            "measurements": measurements
-        }
+        if self.scan_mode == 'adaptive':
+            self.measure_adaptive(writer)
+        else:
+            self.measure_rows(writer, step_x, step_y)
         
-        with open(self.filename, 'w') as f:
-            json.dump(result, f)
+        writer.finalize(self.filename)
+        self.resume_file = ''
         
         print("Done")
         ui.notify(f'Measurement completed and saved to {self.filename}')
 
+class ScreenLocator:
+    """
+    Browser counterpart of the pygame ManualScreenLocator: drag the corners of
+    the screen over a measurement and store them next to it, where compensate
+    picks them up
+    """
+    DISPLAY_WIDTH = 1024
+    CORNER_RADIUS = 10
+
+    def __init__(self):
+        self.measurement = ''
+        self.data = None
+        self.scale = 1.0
+        # In measurement cells, ordered like defaultCorners
+        self.corners = []
+        self.active = None
+        self.image = None
+
+    def load(self):
+        from .image import readScreenGeometry
+        try:
+            self.data = np.asarray(loadMeasurement(self.measurement).values, dtype=np.float64)
+        except (OSError, ValueError) as e:
+            ui.notify(f'Cannot load {self.measurement}: {e}')
+            return
+        h, w = self.data.shape
+        self.scale = self.DISPLAY_WIDTH / w
+        self.corners = readScreenGeometry(self.measurement) or [(0, 0), (0, h), (w, 0), (w, h)]
+        self.image.set_source(self.render())
+        self.redraw()
+
+    def render(self):
+        """
+        The measurement as a grayscale PNG data URL scaled to DISPLAY_WIDTH
+        """
+        img = np.nan_to_num(255 * self.data / np.nanmax(self.data)).clip(0, 255).astype(np.uint8)
+        h, w = img.shape
+        img = cv.resize(img, (self.DISPLAY_WIDTH, round(h * self.scale)), interpolation=cv.INTER_NEAREST)
+        _, png = cv.imencode('.png', img)
+        return 'data:image/png;base64,' + base64.b64encode(png.tobytes()).decode()
+
+    def redraw(self):
+        points = [(x * self.scale, y * self.scale) for x, y in self.corners]
+        outline = ' '.join(f'{x},{y}' for x, y in [points[i] for i in (0, 2, 3, 1)])
+        content = f'<polygon points="{outline}" fill="none" stroke="red" stroke-width="3" />'
+        for x, y in points:
+            content += f'<circle cx="{x}" cy="{y}" r="{self.CORNER_RADIUS}" fill="none" stroke="red" />'
+        self.image.content = content
+
+    def on_mouse(self, e):
+        if self.data is None:
+            return
+        pos = (e.image_x / self.scale, e.image_y / self.scale)
+        if e.type == 'mousedown':
+            distances = [np.hypot(x - pos[0], y - pos[1]) * self.scale for x, y in self.corners]
+            nearest = int(np.argmin(distances))
+            self.active = nearest if distances[nearest] < 2 * self.CORNER_RADIUS else None
+        elif e.type == 'mouseup':
+            self.active = None
+        elif self.active is not None:
+            self.corners[self.active] = pos
+            self.redraw()
+
+    def locate_automatically(self):
+        from .image import locateScreenAutomatic
+        if self.data is None:
+            ui.notify('Please load a measurement first!')
+            return
+        corners = locateScreenAutomatic(self.data, (np.nanmin(self.data) + np.nanmax(self.data)) / 2)
+        if corners is None:
+            ui.notify('Cannot locate the screen automatically')
+            return
+        self.corners = corners
+        self.redraw()
+
+    def save(self):
+        from .image import orderCorners, refineCorners, screenGeometryPath, writeScreenGeometry
+        if self.data is None:
+            ui.notify('Please load a measurement first!')
+            return
+        self.corners = refineCorners(self.data, orderCorners(self.corners))
+        writeScreenGeometry(self.measurement, self.corners, 'manual')
+        self.redraw()
+        ui.notify(f'Screen corners stored in {screenGeometryPath(self.measurement)}')
+
+    def create_ui(self):
+        with ui.column().classes('w-full items-center'):
+            ui.label('Screen Locator').classes('text-xl')
+            with ui.row().classes('gap-4 m-4 items-center'):
+                ui.input('Measurement').bind_value(self, 'measurement')
+                ui.button('Load', on_click=self.load)
+                ui.button('Locate Automatically', on_click=self.locate_automatically)
+                ui.button('Refine & Save', on_click=self.save)
+            self.image = ui.interactive_image(on_mouse=self.on_mouse,
+                events=['mousedown', 'mousemove', 'mouseup']).style(f'width: {self.DISPLAY_WIDTH}px')
+
 class DrLCDUI:
     def __init__(self):
         self.controller = LCDController()
+        self.locator = ScreenLocator()
     
     def create_ui(self):
         with ui.column().classes('w-full items-center'):
@@ -234,13 +519,40 @@ class DrLCDUI:
             
             # Measurement parameters
             with ui.row().classes('gap-4 m-4'):
-                ui.number('Sleep Time (s)', value=self.controller.sleeptime, on_change=lambda e: setattr(self.controller, 'sleeptime', e.value))
+                ui.number('Min Settle Time (s)', value=self.controller.sleeptime, on_change=lambda e: setattr(self.controller, 'sleeptime', e.value))
                 ui.number('Brightness Threshold', value=self.controller.brightness_threshold, on_change=lambda e: setattr(self.controller, 'brightness_threshold', e.value))
                 ui.number('Sensor Accuracy', value=self.controller.sensor_accuracy, on_change=lambda e: setattr(self.controller, 'sensor_accuracy', e.value))
             
+            # Settle detection
+            with ui.row().classes('gap-4 m-4'):
+                ui.number('Settle Window (readings)', value=self.controller.settle_window, min=1, precision=0, on_change=lambda e: setattr(self.controller, 'settle_window', e.value))
+                ui.number('Settle Timeout (s)', value=self.controller.settle_timeout, on_change=lambda e: setattr(self.controller, 'settle_timeout', e.value))
+                ui.number('Settle Retries', value=self.controller.settle_retries, on_change=lambda e: setattr(self.controller, 'settle_retries', e.value))
+            
+            # Scan mode
+            with ui.row().classes('gap-4 m-4'):
+                ui.select({'point': 'Point by point', 'flying': 'Flying (continuous rows)', 'adaptive': 'Adaptive (coarse to fine)'}, label='Scan Mode').bind_value(self.controller, 'scan_mode')
+                ui.number('Sweep Speed (%)', value=self.controller.sweep_speed, on_change=lambda e: setattr(self.controller, 'sweep_speed', e.value))
+                ui.number('Sweep Ramp (s)', value=self.controller.sweep_ramp, on_change=lambda e: setattr(self.controller, 'sweep_ramp', e.value))
+                ui.number('Sensor Latency (s)', value=self.controller.sensor_latency, on_change=lambda e: setattr(self.controller, 'sensor_latency', e.value))
+            
+            # Scan path
+            with ui.row().classes('gap-4 m-4'):
+                ui.select(list(STRATEGIES), label='Path Strategy').bind_value(self.controller, 'path_strategy')
+                ui.checkbox('Corner Tour').bind_value(self.controller, 'corner_tour')
+            
+            # Adaptive sampling
+            with ui.row().classes('gap-4 m-4'):
+                ui.number('Coarse Stride', value=self.controller.coarse_stride, on_change=lambda e: setattr(self.controller, 'coarse_stride', e.value))
+                ui.number('Refine Tolerance', value=self.controller.refine_tolerance, on_change=lambda e: setattr(self.controller, 'refine_tolerance', e.value))
+                ui.number('Refine Batch', value=self.controller.refine_batch, on_change=lambda e: setattr(self.controller, 'refine_batch', e.value))
+            
             # Filename input
             ui.input('Output Filename', value=self.controller.filename).bind_value(self.controller, 'filename')
             
+            # Row log of an interrupted measurement to continue
+            ui.input('Resume From (partial file)').bind_value(self.controller, 'resume_file')
+            
             # Start measurement button
             ui.button('Start Measurement', on_click=self.controller.start_measurement).classes('m-4')
             
@@ -249,10 +561,25 @@ class DrLCDUI:
             ui.label().bind_text_from(self.controller, 'current_y', lambda y: f'Current Y: {y:.1f}mm')
             ui.label().bind_text_from(self.controller, 'origin_offset', lambda o: f'Origin Offset: {o[0]:.1f}mm, {o[1]:.1f}mm')
 
-def main():
+        ui.separator()
+        self.locator.create_ui()
+
+@click.command()
+@click.option("--resume", type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="Continue an interrupted measurement from its partial row log")
+@click.option("--path", "path_strategy", type=click.Choice(list(STRATEGIES)), default="serpentine",
+    help="Visiting order of point-by-point scans")
+def main(resume, path_strategy):
     drlcd_ui = DrLCDUI()
+    drlcd_ui.controller.path_strategy = path_strategy
+    if resume:
+        drlcd_ui.controller.load_resume(resume)
     drlcd_ui.create_ui()
     ui.run(title='Dentoo UV Sensor', port=8080)
 
-if __name__ in {"__main__", "__mp_main__"}:
+if __name__ == "__main__":
     main()
+elif __name__ == "__mp_main__":
+    # NiceGUI serves from a worker process; a standalone click command would
+    # exit it right after ui.run returns control
+    main(standalone_mode=False)
@@ -1,5 +1,7 @@
+import json
+import os
 import click
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 class Resolution(click.ParamType):
     """
@@ -20,3 +22,34 @@ class Resolution(click.ParamType):
             return tuple([int(x) for x in splitted])
         except ValueError as e:
             self.fail("Invalid number specified")
+
+class Corners(click.ParamType):
+    """
+    A CLI argument type for the four screen corners in measurement cells.
+    Either a semicolon separated list of `x,y` pairs or a path to a JSON file
+    with a list of `[x, y]` pairs or an object with a "corners" key like the
+    .screen.json files stored next to measurements. A list of pairs is
+    accepted as well.
+    """
+    name = "corners"
+
+    def convert(self, value, param: Optional[click.Parameter], ctx: click.Context) -> List[Tuple[float, float]]:
+        corners = value
+        if isinstance(value, str):
+            if os.path.isfile(value):
+                try:
+                    with open(value) as f:
+                        corners = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.fail(f"Cannot read corners from {value}: {e}", param, ctx)
+                if isinstance(corners, dict):
+                    corners = corners.get("corners")
+            else:
+                corners = [pair.split(",") for pair in value.split(";") if pair.strip()]
+        try:
+            corners = [(float(x), float(y)) for x, y in corners]
+        except (TypeError, ValueError):
+            self.fail(f"{value} is neither a JSON file nor a list of x,y pairs separated by ';'", param, ctx)
+        if len(corners) != 4:
+            self.fail(f"Expected 4 corners, got {len(corners)}", param, ctx)
+        return corners
@@ -8,7 +8,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="DrLCD",
-    python_requires='>=3.7',
+    python_requires='>=3.8',
     version="0.1.0",
     author="Jan Mrázek",
     author_email="email@honzamrazek.cz",
@@ -28,7 +28,8 @@ setuptools.setup(
         "opencv-python~=4.6",
         "scipy~=1.9",
         "pygame~=2.1",
-        "plotly~=5.11"
+        "plotly>=6",
+        "tomli; python_version < '3.11'"
     ],
     extras_require={
         "dev": ["pytest"],
@@ -1,18 +1,9 @@
 import numpy as np
-import json
+from drlcd.io import loadMeasurement
 
 def analyze_measurements(filename, description):
     # Load the measurement data
-    with open(filename, 'r') as f:
-        data = json.load(f)
-
-    # Convert measurements to numpy array - handle both formats
-    if isinstance(data['measurements'][0][0], dict):
-        # Format with dictionaries containing 'value' key
-        measurements = np.array([[point['value'] for point in row] for row in data['measurements']])
-    else:
-        # Format with direct numeric values
-        measurements = np.array(data['measurements'])
+    measurements = loadMeasurement(filename).values
 
     # Calculate key statistics
     min_val = np.min(measurements)
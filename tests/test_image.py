@@ -0,0 +1,42 @@
+import json
+import numpy as np
+from click.testing import CliRunner
+
+from drlcd.image import normalizeData, replacePeaks, visualize
+
+def measurementWithHoles(path, width=12, height=8):
+    y, x = np.mgrid[0:height, 0:width]
+    values = 4 + np.exp(-((x - width / 2) / width) ** 2 - ((y - height / 2) / height) ** 2)
+    rows = [[{"value": float(values[j, i]), "x": 2.0 * i, "y": 2.0 * j} for i in range(width)]
+            for j in range(height)]
+    # A missing reading of a flying scan and an unmeasured row
+    rows[3][5] = {}
+    rows[-1] = [{} for _ in range(width)]
+    with open(path, "w") as f:
+        json.dump({"sensor": "TSL2561", "size": [2.0 * width, 2.0 * height],
+                   "resolution": [width, height], "measurements": rows}, f)
+
+def test_replacePeaksIgnoresMissingNeighbors():
+    data = np.ones((5, 5))
+    data[2, 2] = 10
+    data[1, 1] = np.nan
+    result = replacePeaks(data, 5, 3)
+    assert result[2, 2] == 1
+    assert np.isnan(result[1, 1])
+
+def test_normalizeDataKeepsMissingCells():
+    result = normalizeData([[1, 2, 3], [4, np.nan, 6]])
+    assert np.isnan(result[1, 1])
+    assert np.isfinite(np.delete(result.ravel(), 4)).all()
+
+def test_visualizeMeasurementWithHoles(tmp_path, monkeypatch):
+    monkeypatch.setenv("DRLCD_CACHE_DIR", str(tmp_path / "cache"))
+    measurement = tmp_path / "holes.json"
+    measurementWithHoles(measurement)
+    for options in [[], ["--max-cells", "20"]]:
+        output = tmp_path / "plot.html"
+        result = CliRunner().invoke(visualize, [*options, str(measurement), str(output)])
+        assert result.exit_code == 0, result.output
+        html = output.read_text()
+        assert "Min: nan" not in html and "Avg: nan" not in html
+        assert '"bdata"' in html
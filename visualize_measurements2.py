@@ -1,37 +1,16 @@
-import json
 import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
+from drlcd.io import loadMeasurement
 
 def load_measurement_data(file_path):
-    """Load and process measurement data from JSON file."""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    
-    # Extract dimensions
-    width, height = data['size']
-    resolution = data['resolution']
-    measurements = data['measurements']
-    
-    # Create empty array for values
-    values = np.zeros((resolution[1], resolution[0]))
-    
-    # Check if measurements is a list of lists of dictionaries or just a list of lists
-    if isinstance(measurements[0][0], dict):
-        # Format with dictionaries containing x, y, value
-        for y, row in enumerate(measurements):
-            for x, point in enumerate(row):
-                values[y, x] = point['value']
-    else:
-        # Format with direct values
-        for y, row in enumerate(measurements):
-            for x, value in enumerate(row):
-                values[y, x] = value
+    """Load and process measurement data from a measurement file."""
+    measurement = loadMeasurement(file_path)
     
     # Flip the array vertically to mirror the y-axis
-    values = np.flipud(values)
+    values = np.flipud(measurement.values)
     
-    return values, data['sensor']
+    return values, measurement.sensor
 
 def plot_measurement_comparison(measurement_files, output_path=None):
     """Plot two measurements and their difference side by side."""